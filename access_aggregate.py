@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Municipal ratings from the per-origin travel times.
+
+"calculate municipal ratings on GN values.R" merges each accX.csv with inOsnap.csv on NN,
+multiplies by wpop and sums with xtabs by xmid, once per service by hand, overwriting
+drivetime1.csv between steps. MunicipalAccumulator does every service and rank in one pass:
+the origins' municipality IDs become row positions, and each statistic is one weighted
+np.bincount over the million origins. Only per-municipality sums and a fixed-bin weighted
+histogram are kept, so batches of origins can be added one after another (or accumulators
+merged) and give the same result as the whole table at once.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class MunicipalAccumulator(object):
+    """
+    Population-weighted summaries of travel time columns (e.g. 1D..3E, mm1D..mm3E) by group.
+
+    columns: the time columns to summarize, in minutes (NaN where there is no path)
+    thresholds: times for the share of population beyond them (unreachable origins count as beyond)
+    percentiles: population-weighted percentiles, read from a histogram with bins of
+        bin_width minutes up to max_time. Unreachable origins count as infinitely far, so a
+        percentile that falls among them (or beyond max_time) is inf.
+    groups: the group IDs (e.g. the 78 municipio xmid values). Groups seen later are added.
+
+    frame() gives one row per group and column: group, variable, wpopm (population of the
+    group), wpop_reached (population with a path), mean (over the reached population, as
+    the R script's wpop-weighted sum / wpopm when everyone is reached), the percentiles
+    (p50...) and the shares beyond each threshold (beyond30...).
+    """
+
+    def __init__(self, columns, thresholds = (30, 60), percentiles = (50, 90), bin_width = 0.5,
+                 max_time = 360, groups = None):
+        self.columns = list(columns)
+        self.thresholds = list(thresholds)
+        self.percentiles = list(percentiles)
+        self.bin_width = float(bin_width)
+        self.n_bins = int(np.ceil(max_time / self.bin_width))
+        self.groups = np.zeros(0, dtype = np.int64)
+        self.wpop = np.zeros(0)
+        c, t, b = len(self.columns), len(self.thresholds), self.n_bins + 1 # last bin: beyond max_time or no path
+        self.reached = np.zeros((c, 0))
+        self.weighted = np.zeros((c, 0))
+        self.beyond = np.zeros((c, t, 0))
+        self.hist = np.zeros((c, 0, b))
+        if groups is not None:
+            self._positions(np.asarray(groups))
+
+    def _positions(self, group):
+        # Row of each group ID, adding rows for IDs not seen yet.
+        group = np.asarray(group, dtype = np.int64)
+        new = np.setdiff1d(np.unique(group), self.groups)
+        if len(new):
+            at = np.searchsorted(self.groups, new)
+            self.groups = np.insert(self.groups, at, new)
+            self.wpop = np.insert(self.wpop, at, 0.0)
+            self.reached = np.insert(self.reached, at, 0.0, axis = 1)
+            self.weighted = np.insert(self.weighted, at, 0.0, axis = 1)
+            self.beyond = np.insert(self.beyond, at, 0.0, axis = 2)
+            self.hist = np.insert(self.hist, at, 0.0, axis = 1)
+        return np.searchsorted(self.groups, group)
+
+    def add(self, group, wpop, times):
+        """
+        Add a batch of origins.
+
+        group: municipality ID of each origin (e.g. xmid); origins without one are skipped
+        wpop: population of each origin
+        times: DataFrame (or dict of arrays) with the columns, one row per origin
+        """
+        group = pd.to_numeric(pd.Series(np.asarray(group)), errors = 'coerce').values
+        w = np.nan_to_num(np.asarray(wpop, dtype = np.float64))
+        ok = np.isfinite(group)
+        pos = self._positions(group[ok])
+        w = w[ok]
+        n = len(self.groups)
+        b = self.n_bins + 1
+        self.wpop += np.bincount(pos, weights = w, minlength = n)
+        for i, c in enumerate(self.columns):
+            t = np.asarray(times[c], dtype = np.float64)[ok]
+            has = np.isfinite(t)
+            wt = np.where(has, w, 0.0)
+            self.reached[i] += np.bincount(pos, weights = wt, minlength = n)
+            self.weighted[i] += np.bincount(pos, weights = wt * np.where(has, t, 0.0), minlength = n)
+            for j, thr in enumerate(self.thresholds):
+                self.beyond[i, j] += np.bincount(pos, weights = np.where(has & (t <= thr), 0.0, w), minlength = n)
+            with np.errstate(invalid = 'ignore'):
+                bins = np.where(has, np.clip(np.floor(t / self.bin_width), 0, self.n_bins), self.n_bins).astype(np.int64)
+            self.hist[i] += np.bincount(pos * b + bins, weights = w, minlength = n * b).reshape(n, b)
+        return self
+
+    def merge(self, other):
+        # Add the sums of another accumulator with the same columns and settings.
+        pos = self._positions(other.groups)
+        self.wpop[pos] += other.wpop
+        self.reached[:, pos] += other.reached
+        self.weighted[:, pos] += other.weighted
+        self.beyond[:, :, pos] += other.beyond
+        self.hist[:, pos] += other.hist
+        return self
+
+    def _percentile(self, hist, q):
+        # Population-weighted percentile q of each group, interpolated within its histogram bin.
+        cum = np.cumsum(hist, axis = 1)
+        target = cum[:, -1] * q / 100.0
+        k = np.minimum((cum < target[:, None]).sum(axis = 1), self.n_bins)
+        r = np.arange(len(hist))
+        before = np.where(k > 0, cum[r, np.maximum(k - 1, 0)], 0.0)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            frac = np.clip(np.where(hist[r, k] > 0, (target - before) / hist[r, k], 0.0), 0, 1)
+        out = (k + frac) * self.bin_width
+        out[k >= self.n_bins] = np.inf
+        out[cum[:, -1] <= 0] = np.nan
+        return out
+
+    def frame(self, group = 'xmid'):
+        # The tidy table: one row per group and variable.
+        out = []
+        for i, c in enumerate(self.columns):
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                df = pd.DataFrame({group: self.groups, 'variable': c, 'wpopm': self.wpop,
+                                   'wpop_reached': self.reached[i],
+                                   'mean': self.weighted[i] / self.reached[i]})
+                for q in self.percentiles:
+                    df['p%g' % q] = self._percentile(self.hist[i], q)
+                for j, thr in enumerate(self.thresholds):
+                    df['beyond%g' % thr] = self.beyond[i, j] / self.wpop
+            out.append(df)
+        return pd.concat(out, ignore_index = True)
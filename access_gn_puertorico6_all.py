@@ -30,18 +30,24 @@ Configure script.
 import os, sys
 gostNetsFolder = os.path.dirname(os.getcwd())
 sys.path.insert(0, gostNetsFolder)
-import GOSTnet as gn
+import access_network as an
+import access_od as ao
+import access_origins as aor
+import access_raster as ar
+import access_osm as aosm
+import access_pipeline as ap
+import access_aggregate as aa
 import pandas as pd
 from geopandas import GeoDataFrame
 import shapely
-from shapely.geometry import Point, box
+from shapely.geometry import Point
 import geopandas as gpd
-import osmnx as ox
-import networkx as nx
 import numpy as np
-import rasterio as rt
 
 # Didn't use:
+import GOSTnet as gn # replaced by the access_* modules; named in the comments below
+import osmnx as ox
+import networkx as nx
 import fiona
 import peartree
 from osgeo import gdal
@@ -155,13 +161,17 @@ Travel measured in length (meters).
 
 """
 
-gDrive = ox.graph_from_polygon(bound, network_type= 'drive')
-# This took about half an hour.
-# Note: length is measured in meters.
+# Offline: drivable ways inside bound straight from a local OSM extract, split at intersections,
+# with each edge's length (meters) and highway class. No download, no NetworkX graph.
+# puerto-rico-latest.osm.pbf from download.geofabrik.de/north-america/us/puerto-rico.html
+gDriveCSR = aosm.pbf_to_csr(os.path.join(pth, 'puerto-rico-latest.osm.pbf'), aoi = bound)
+an.save_csr(gDriveCSR, os.path.join(pth, 'gDrive_csr'))
+# Travel times for any speed profile are built from it below.
 
-# Save all road nodes (points on the road) to file.
-gDrive_node_gdf = gn.node_gdf_from_graph(gDrive)
-gDrive_node_gdf.to_csv(os.path.join(pth, 'drive_dist_node.csv'))
+# Same arrays from the osmnx download instead of the extract (this took about half an hour):
+# gDrive = ox.graph_from_polygon(bound, network_type= 'drive')
+# gDriveCSR = an.graph_to_csr(gDrive, weight = None, length = 'length', highway = 'highway')
+# Note: length is measured in meters.
 
 
 #%% 
@@ -187,23 +197,22 @@ speed_dict = {
                 'crossing':20,
                 'living_street':20
                 }
-gTime = gn.convert_network_to_time(gDrive, distance_tag = 'length', graph_type = networkType, speed_dict = speed_dict)
-# Note: time is in seconds.
-
-# Save road nodes and road edges to file. Edges contains time measure.
-edges = gn.edge_gdf_from_graph(gTime)
-nodes = gn.node_gdf_from_graph(gTime)
-edges.to_csv(os.path.join(pth, 'drive_time_edge.csv'))
-nodes.to_csv(os.path.join(pth, 'drive_time_node.csv'))
+# Compact routing graph: int32 node indices, float32 edge times, osmid map.
+# Times are length / speed of each highway class, cached in gDrive_csr under a hash of speed_dict,
+# so editing speed_dict (or switching to another profile) only rebuilds one array, in under a second.
+gCSR = an.with_speeds(gDriveCSR, speed_dict, os.path.join(pth, 'gDrive_csr'))
+# Note: time is in seconds. Same times as gn.convert_network_to_time(gDrive, ...).
+
+# Save the network (replaces gTime.pickle, drive_time_node.csv and drive_time_edge.csv):
+# adjacency arrays, typed node columns (node_ID, x, y) and edge columns (time, length, highway),
+# with a schema.json holding the format version and a checksum of every file.
+net = an.save_network(os.path.join(pth, 'gTime_csr'), gCSR, meta = {'speed_dict': speed_dict})
 # 171,222 road nodes 
 
 
-# Save a pickle of the graph with the time measure for easy recall.
-gn.save(gTime, 'gTime', '', edges = False, nodes = False)
-
-
 #%% If starting new session, reload graph from file
-gTime = nx.read_gpickle("gTime.pickle")
+net = an.load_network(os.path.join(pth, 'gTime_csr')) # Memory-mapped, loads in well under a second.
+gCSR = net.csr
 
 
 #%%
@@ -214,50 +223,44 @@ Measure distance from origin/destination to nearest node and save to file.
 
 """
 
-# pandana_snap calculates the great circle distance between the origin and nearest road node.
-# Took maybe 20 min for Origins. Much shorter for the rest.
+# Snap index over the road nodes projected to epsg:3920, built once and saved with the graph.
+# Replaces a gn.pandana_snap per layer (maybe 20 min for Origins). Distances are in meters.
 # Adding x,y fields on origins file for later use with add_elevation function.
 inO['x'] = inO['geometry'].x
 inO['y'] = inO['geometry'].y
-inOsnap = gn.pandana_snap(gTime, inO, source_crs = 'epsg:4326', target_crs = 'epsg:3920', add_dist_to_node_col = True)
-inOsnap.to_csv('inOsnap.csv', index=True)
+snap_index = aor.build_snap_index(gCSR, source_crs = 'epsg:4326', target_crs = 'epsg:3920')
+snap_index.save(os.path.join(pth, 'snap_index'))
+# If starting new session: snap_index = aor.load_snap_index(os.path.join(pth, 'snap_index'))
 
-inDsnap = gn.pandana_snap(gTime, inD, source_crs = 'epsg:4326', target_crs = 'epsg:3920', add_dist_to_node_col = True)
-inDsnap.to_csv('inDsnap.csv', index=True)
-inHsnap = gn.pandana_snap(gTime, inH, source_crs = 'epsg:4326', target_crs = 'epsg:3920', add_dist_to_node_col = True)
-inHsnap.to_csv('inHsnap.csv', index=True)
-inGsnap = gn.pandana_snap(gTime, inG, source_crs = 'epsg:4326', target_crs = 'epsg:3920', add_dist_to_node_col = True)
-inGsnap.to_csv('inGsnap.csv', index=True)
-inPsnap = gn.pandana_snap(gTime, inP, source_crs = 'epsg:4326', target_crs = 'epsg:3920', add_dist_to_node_col = True)
-inPsnap.to_csv('inPsnap.csv', index=True)
-inEsnap = gn.pandana_snap(gTime, inE, source_crs = 'epsg:4326', target_crs = 'epsg:3920', add_dist_to_node_col = True)
-inEsnap.to_csv('inEsnap.csv', index=True)
+# Look at the 8 nearest nodes and take the first one on a piece of network with at least 100 nodes,
+# so points don't snap to disconnected road fragments.
+main_network = an.component_mask(gCSR, min_nodes = 100)
+inOsnap = aor.snap_points(snap_index, inO, k = 8, valid = main_network) # Under a minute.
+inDsnap = aor.snap_points(snap_index, inD, k = 8, valid = main_network)
+inHsnap = aor.snap_points(snap_index, inH, k = 8, valid = main_network)
+inGsnap = aor.snap_points(snap_index, inG, k = 8, valid = main_network)
+inPsnap = aor.snap_points(snap_index, inP, k = 8, valid = main_network)
+inEsnap = aor.snap_points(snap_index, inE, k = 8, valid = main_network)
 
 
 
-# Save to file
-inOsnap.to_csv(os.path.join(pth, 'inOsnap.csv'))
-inDsnap.to_csv(os.path.join(pth, 'inDsnap.csv'))
-inHsnap.to_csv(os.path.join(pth, 'inHsnap.csv'))
-inGsnap.to_csv(os.path.join(pth, 'inGsnap.csv'))
-inPsnap.to_csv(os.path.join(pth, 'inPsnap.csv'))
-inEsnap.to_csv(os.path.join(pth, 'inEsnap.csv'))
+# Save to file. Parquet checkpoints keep dtypes, the index and geometry (as WKB); seconds instead of minutes.
+ap.write_checkpoint(inOsnap, os.path.join(pth, 'inOsnap.parquet'))
+ap.write_checkpoint(inDsnap, os.path.join(pth, 'inDsnap.parquet'))
+ap.write_checkpoint(inHsnap, os.path.join(pth, 'inHsnap.parquet'))
+ap.write_checkpoint(inGsnap, os.path.join(pth, 'inGsnap.parquet'))
+ap.write_checkpoint(inPsnap, os.path.join(pth, 'inPsnap.parquet'))
+ap.write_checkpoint(inEsnap, os.path.join(pth, 'inEsnap.parquet'))
 
 
 
 #%% If already created, load from file.
-inOsnap = os.path.join(gostNetsFolder, "SampleData", "inOsnap.csv")
-inOsnap = pd.read_csv(inOsnap)
-inDsnap = os.path.join(gostNetsFolder, "SampleData", "inDsnap.csv")
-inDsnap = pd.read_csv(inDsnap)
-inHsnap = os.path.join(gostNetsFolder, "SampleData", "inHsnap.csv")
-inHsnap = pd.read_csv(inHsnap)
-inGsnap = os.path.join(gostNetsFolder, "SampleData", "inGsnap.csv")
-inGsnap = pd.read_csv(inGsnap)
-inPsnap = os.path.join(gostNetsFolder, "SampleData", "inPsnap.csv")
-inPsnap = pd.read_csv(inPsnap)
-inEsnap = os.path.join(gostNetsFolder, "SampleData", "inEsnap.csv")
-inEsnap = pd.read_csv(inEsnap)
+inOsnap = ap.read_checkpoint(os.path.join(pth, 'inOsnap.parquet'))
+inDsnap = ap.read_checkpoint(os.path.join(pth, 'inDsnap.parquet'))
+inHsnap = ap.read_checkpoint(os.path.join(pth, 'inHsnap.parquet'))
+inGsnap = ap.read_checkpoint(os.path.join(pth, 'inGsnap.parquet'))
+inPsnap = ap.read_checkpoint(os.path.join(pth, 'inPsnap.parquet'))
+inEsnap = ap.read_checkpoint(os.path.join(pth, 'inEsnap.parquet'))
 
 
 
@@ -267,94 +270,16 @@ inEsnap = pd.read_csv(inEsnap)
 Map elevation onto road nodes and points of origin
 
 """
-# If starting new session, load road nodes from disk.
-nodes = os.path.join(gostNetsFolder, "SampleData", "drive_time_node.csv")
-nodes = gpd.read_file(nodes)
+# Road nodes from the network: node_ID (int64), x, y (float64) are stored typed, no re-casting needed.
+nodes = net.node_table()
 
-#%%
 
-# Ensure nodes coordinates and unique ID field are in the right data type.
-nodes['x'] = nodes['x'].astype('float')
-nodes['y'] = nodes['y'].astype('float')
-nodes['osmid'] = nodes['osmid'].astype(int)
-
-
-def add_elevation(df, x, y, srtm_pth):
-    # walk all tiles, find path
-
-    tiles = []
-    for root, folder, files in os.walk(os.path.join(srtm_pth,'high_res')):
-        for f in files:
-            if f[-3:] == 'hgt':
-                tiles.append(f[:-4])
-
-    # load dictionary of tiles
-    arrs = {}
-    for t in tiles:
-         arrs[t] = rt.open(srtm_pth+r'\high_res\{}.hgt\{}.hgt'.format(t, t), 'r')
-    # assign a code
-    uniques = []
-    df['code'] = 'placeholder'
-    def tile_code(z):
-        E = str(abs(z[x])+1)[:2]
-        N = str(abs(z[y]))[:2]
-        return 'N{}W0{}'.format(N, E)
-    df['code'] = df.apply(lambda z: tile_code(z), axis = 1)
-    unique_codes = list(set(df['code'].unique()))
-
-    z = {}
-    # Match on High Precision Elevation
-    property_name = 'elevation'
-    for code in unique_codes:
-
-        df2 = df.copy()
-        df2 = df2.loc[df2['code'] == code]
-        dataset = arrs[code]
-        b = dataset.bounds
-        datasetBoundary = box(b[0], b[1], b[2], b[3])
-        selKeys = []
-        selPts = []
-        for index, row in df2.iterrows():
-            selPts.append((row[x],row[y]))
-            selKeys.append(index)
-        raster_values = list(dataset.sample(selPts))
-        raster_values = [x[0] for x in raster_values]
-        # generate new dictionary of {node ID: raster values}
-        z.update(zip(selKeys, raster_values))
-    
-    elev_df = pd.DataFrame.from_dict(z, orient='index')
-    elev_df.columns = ['elevation']
-    
-    missing = elev_df.copy()
-    missing = missing.loc[missing.elevation < 0]
-    
-    print('missing: %s' % len(missing))
-    
-    if len(missing) > 0:
-        missing_df = df.copy()
-        missing_df = missing_df.loc[missing.index]
-        low_res_tifpath = os.path.join(srtm_pth, 'clipped', 'W100N40.GIF')
-        dataset = rt.open(low_res_tifpath, 'r')
-        b = dataset.bounds
-        datasetBoundary = box(b[0], b[1], b[2], b[3])
-        selKeys = []
-        selPts = []
-        for index, row in missing_df.iterrows():
-            if Point(row[x], row[y]).intersects(datasetBoundary):
-                selPts.append((row[x],row[y]))
-                selKeys.append(index)
-        raster_values = list(dataset.sample(selPts))
-        raster_values = [x[0] for x in raster_values]
-        z.update(zip(selKeys, raster_values))
-
-        elev_df = pd.DataFrame.from_dict(z, orient='index')
-        elev_df.columns = ['elevation']
-    df['point_elev'] = elev_df['elevation']
-    df = df.drop('code', axis = 1)
-    return df
-
-
-nodes_elev = add_elevation(nodes, "x", "y", pth) # Takes a few minutes.
+# access_raster.add_elevation groups points by SRTM tile with floor arithmetic, reads each .hgt once
+# and gathers values through the affine transform. Voids fall back to the low-res W100N40 layer.
+# Tiles are listed once in pth/tile_index.json (rebuild = True after adding tiles), and decoded
+# tiles stay in an LRU cache (1 GB cap) so the nodes and origins lookups share them.
+ar.load_tile_index(pth)
+nodes_elev = ar.add_elevation(nodes, "x", "y", pth) # A few seconds, was a few minutes.
 
 # Origin points are different from road nodes. Need elevation for both.
 # Using inOsnap was giving the error: 'Series' object has no attribute 'x'. 
@@ -364,19 +289,18 @@ inOsnap2 = pd.merge(inO[['wpop', 'xmid', 'wid', 'municipio', 'geometry', 'x', 'y
                     inOsnap[['wid', 'NN', 'NN_dist']], on='wid', how='left')
 inOsnap2.dtypes
 inOsnap2.isna().sum()
-O_elev = add_elevation(inOsnap2, "x", "y", pth) # Started 11:21pm
+O_elev = ar.add_elevation(inOsnap2, "x", "y", pth) # Seconds for ~1 million points.
 
 
-# Save to file.
-nodes_elev.to_csv(os.path.join(pth, 'nodes_elev.csv'))
-O_elev.to_csv(os.path.join(pth, 'O_elev.csv'))
+# Save to file. Node elevation goes into the network as a node column.
+an.add_network_column(os.path.join(pth, 'gTime_csr'), 'nodes', 'point_elev', nodes_elev['point_elev'].values)
+ap.write_checkpoint(O_elev, os.path.join(pth, 'O_elev.parquet'))
 
 
 #%% Reload from disk.
-nodes_elev = os.path.join(pth, "nodes_elev.csv")
-nodes_elev = gpd.read_file(nodes_elev)
-O_elev = os.path.join(pth, "O_elev.csv")
-O_elev = gpd.read_file(O_elev)
+net = an.load_network(os.path.join(pth, 'gTime_csr'))
+nodes_elev = net.node_table(['x', 'y', 'point_elev'])
+O_elev = ap.read_checkpoint(os.path.join(pth, 'O_elev.parquet'))
 
 
 #%% 
@@ -386,51 +310,25 @@ Elevation-adjusted walk time to road.
 
 """
 
-# generate_walktimes function takes a single dataframe, and all numbers must be float.
+# generate_walktimes function takes a single dataframe.
 # Merging the two datasets and cleaning up any naming issues.
 nodes_elev.rename(columns={'node_ID':'NN'}, inplace=True)
 zvalues = pd.merge(O_elev, nodes_elev, on='NN', how='left')
 zvalues.head(5)
 zvalues.rename(columns={'point_elev_y':'node_elev'}, inplace=True)
+zvalues.rename(columns={'point_elev_x':'point_elev'}, inplace=True)
 zvalues.dtypes
-zvalues['point_elev'] = zvalues['point_elev'].astype(float)
-
-
-# Time is in seconds.
-def generate_walktimes(df, start = 'point_elev', end = 'node_elev', dist = 'NN_dist', max_walkspeed = 6, min_speed = 0.1):
-    # Tobler's hiking function: https://en.wikipedia.org/wiki/Tobler%27s_hiking_function
-    def speed(incline_ratio, max_speed):
-        walkspeed = max_speed * np.exp(-3.5 * abs(incline_ratio + 0.05)) 
-        return walkspeed
-
-    speeds = {}
-    times = {}
 
-    for index, data in df.iterrows():
-        if data[dist] > 0:
-            delta_elevation = data[end] - data[start]
-            incline_ratio = delta_elevation / data[dist]
-            speed_kmph = speed(incline_ratio = incline_ratio, max_speed = max_walkspeed)
-            speed_kmph = max(speed_kmph, min_speed)
-            speeds[index] = (speed_kmph)
-            times[index] = (data[dist] / 1000 * 3600 / speed_kmph)
 
-    speed_df = pd.DataFrame.from_dict(speeds, orient = 'index')
-    time_df = pd.DataFrame.from_dict(times, orient = 'index')
-
-    df['walkspeed'] = speed_df[0]
-    df['walk_time'] = time_df[0]
-    
-    return df
-
-zwalk = generate_walktimes(zvalues) # Takes about 5 minutes.
+# Time is in seconds. Computed on whole columns (access_origins.generate_walktimes) instead of iterrows.
+# Origins sitting on their road node (NN_dist == 0) get a walk_time of 0 rather than NaN.
+zwalk = aor.generate_walktimes(zvalues, dtype = np.float32) # Under a second, was about 5 minutes.
 zwalk.head(5)
-zwalk.to_csv('zwalk_full.csv', index=True) # Takes a few minutes.
+ap.write_checkpoint(zwalk, os.path.join(pth, 'zwalk_full.parquet')) # A few seconds.
 
 
 # Clean up the file for only the necessary columns.
-zwalk2 = zwalk.drop(columns=['geometry_x', 'x_x', 'y_x', 'NN_dist', 'point_elev', 
-                                   'x_y', 'y_y', 'ref', 'highway', 'geometry_y', 'node_elev'])
+zwalk2 = zwalk[['wpop', 'xmid', 'wid', 'municipio', 'NN', 'walkspeed', 'walk_time']].copy()
 zwalk2.dtypes
 
 # Convert from seconds to minutes
@@ -438,20 +336,81 @@ zwalk2['walk_time'] = zwalk2['walk_time'] / 60
 zwalk2.head()
 
 # Save to disk.
-zwalk2.to_csv('zwalk.csv', index=True)
+ap.write_checkpoint(zwalk2, os.path.join(pth, 'zwalk.parquet'))
+
 
 
+#%% 
+"""
+Nearest-k drive times per service, without the full OD matrix.
+
+Searches outward from each service's snapped road nodes over the reversed time graph
+and keeps the 3 best times (and the node of the facility each comes from) per road node.
+Replaces the OD matrix and nth nearest filter below for the 1st/2nd/3rd nearest scores.
+
+"""
+fail_value = 999999999
+
+# Times in seconds, fail value where there is no path.
+near = {}
+for label, snap in [('D', inDsnap), ('H', inHsnap), ('G', inGsnap), ('P', inPsnap), ('E', inEsnap)]:
+    near[label] = ao.nearest_k(gCSR, snap.NN, k = 3, weight = 'time', label = label, fail_value = fail_value)
+# One sweep over the road network per service instead of the 2 hour calculate_OD.
+
+def minutes(near, label):
+    # Convert to minutes. No path becomes NaN, as with ODD[ODD < fail_value] / 60.
+    out = near.copy()
+    for r in ['1', '2', '3']:
+        out[r + label] = out[r + label].where(out[r + label] < fail_value) / 60
+    return out
+
+Dall = minutes(near['D'], 'D')
+Hall = minutes(near['H'], 'H')
+Gall = minutes(near['G'], 'G')
+Pall = minutes(near['P'], 'P')
+Eall = minutes(near['E'], 'E')
+
+ap.write_checkpoint(Dall, os.path.join(pth, 'Dt.parquet'))
+ap.write_checkpoint(Hall, os.path.join(pth, 'Ht.parquet'))
+ap.write_checkpoint(Gall, os.path.join(pth, 'Gt.parquet'))
+ap.write_checkpoint(Pall, os.path.join(pth, 'Pt.parquet'))
+ap.write_checkpoint(Eall, os.path.join(pth, 'Et.parquet'))
+
+
+#%% 
+"""
+Optional: snap origins to the nearest road edge instead of the nearest node.
+
+Beside long rural edges the nearest node can be far off. Each origin is projected onto its
+nearest edge and routed from that point as a virtual node: drive on to either end of the edge
+(back to u only on two-way roads), then take that node's nearest-k. The graph is not changed.
+NN_dist becomes the distance from the origin to the road edge.
+
+"""
+# u, v, time, length, highway and the road geometry of each edge (kept from the .osm.pbf ways by
+# aosm.pbf_to_csr). Networks without it get straight lines between the end nodes, which cut
+# across the curves of exactly the long rural edges this snap is for.
+edges = net.edge_table(geometry = True)
+edge_index = aor.build_edge_snap_index(edges, source_crs = 'epsg:4326', target_crs = 'epsg:3920')
+inOedge = aor.snap_to_edges(edge_index, inO)
+
+Eedge = ao.nearest_from_edges(gCSR, inOedge, near['E'], k = 3, label = 'E', fail_value = fail_value)
+Eedge = minutes(Eedge, 'E') # One row per origin, aligned with inOedge.
+
 
 #%% 
 """
 Create origin-destination accessibility scores for the nodes nearest to each service.
 
+Only needed when the full OD matrix is wanted (e.g. to compare against a disrupted network).
+
 """
 
 # Using calculate_OD
 # We only need to find the origin-destination pairs for nodes closest to the origins and services,
 # and some nodes will be the nearest for more than one service.
-origins = list(inOsnap.NN.unique())
+fanout = aor.OriginFanout(inOsnap.NN) # origin -> unique nearest node, int32
+origins = list(fanout.nodes)
 listD = list(inDsnap.NN.unique()) 
 listH = list(inHsnap.NN.unique()) 
 listG = list(inGsnap.NN.unique()) 
@@ -462,51 +421,25 @@ dests = list(set(destslist))
 len(dests) # There are 2,700 unique nearest nodes.
 fail_value = 999999999 # If there is no shortest path, the OD pair will be assigned the fail value.
 
-OD = gn.calculate_OD(gTime, origins, dests, fail_value, weight = 'time')
-ODdf = pd.DataFrame(OD, index = origins, columns = dests)
-# Full 5 variable list (dests) takes about 2 hours.
+# Same result as gn.calculate_OD(gTime, origins, dests, fail_value, weight = 'time'), which took
+# about 2 hours on one core. Runs chunks of origins on all cores against the saved gTime_csr,
+# writing straight into an on-disk float32 OD store (no OD.csv, which ran out of disk and memory).
+# Rerunning after an interruption only computes the missing chunks.
+ODstore = ao.calculate_OD_parallel(os.path.join(pth, 'gTime_csr'), origins, dests,
+                                   os.path.join(pth, 'OD_store'), fail_value, chunk_size = 100)
 # Created a 141873 x 2700 matrix
 
-# Convert to minutes and save to file.
-ODdf.head(5)
-ODmin = ODdf[ODdf <fail_value] / 60
-ODdf.to_csv(os.path.join(pth, 'OD.csv'))
-
-
-# Create POI-specific OD and save to file.
-ODD = ODdf.loc[:, listD]
-ODD = ODD[ODD < fail_value] / 60 
-ODD.to_csv(os.path.join(pth, 'ODD.csv')) # Each takes less than a minute.
-
-ODH = ODdf.loc[:, listH]
-ODH = ODH[ODH < fail_value] / 60 
-ODH.to_csv(os.path.join(pth, 'ODH.csv'))
-
-ODG = ODdf.loc[:, listG]
-ODG = ODG[ODG < fail_value] / 60 
-ODG.to_csv(os.path.join(pth, 'ODG.csv'))
-
-ODP = ODdf.loc[:, listP]
-ODP = ODP[ODP < fail_value] / 60 
-ODP.to_csv(os.path.join(pth, 'ODP.csv'))
-
-ODE = ODdf.loc[:, listE]
-ODE = ODE[ODE < fail_value] / 60 
-ODG.to_csv(os.path.join(pth, 'ODE.csv'))
-
 
 #%% 
 # If starting new session, reload from disk.
-ODD = os.path.join(gostNetsFolder, "SampleData", "ODD.csv")
-ODD = pd.read_csv(ODD)
-ODH = os.path.join(gostNetsFolder, "SampleData", "ODH.csv")
-ODH = pd.read_csv(ODH)
-ODG = os.path.join(gostNetsFolder, "SampleData", "ODG.csv")
-ODG = pd.read_csv(ODG)
-ODP = os.path.join(gostNetsFolder, "SampleData", "ODP.csv")
-ODP = pd.read_csv(ODP)
-ODE = os.path.join(gostNetsFolder, "SampleData", "ODE.csv")
-ODE = pd.read_csv(ODE)
+# Only the origin and destination IDs are read here; each POI-specific OD is sliced from disk
+# in row chunks. Times in minutes, NaN where there is no path (as the old ODD.csv etc).
+ODstore = ao.open_od_store(os.path.join(pth, 'OD_store'))
+ODD = ODstore.frame(listD).reset_index()
+ODH = ODstore.frame(listH).reset_index()
+ODG = ODstore.frame(listG).reset_index()
+ODP = ODstore.frame(listP).reset_index()
+ODE = ODstore.frame(listE).reset_index()
 
 
 
@@ -516,53 +449,20 @@ Filter nth nearest
 
 """
 
-# Check each file to make sure nearest neighbor column is named correctly. If not, rename.
-ODE.head(1)
-ODE.rename(columns={'Unnamed: 0': 'NN'}, inplace=True)
-
-
-
-# Find first nearest POI for each origin node. Run this block for each variable.
-
-ODE["1E"] = 0
-Dsub = ODE.iloc[:,1:-1] # Filtering out the newly created field and the node ID column.
-ODE["1E"] = Dsub.min(axis=1) # Default is axis=0, meaning min value of each column selected. We want min of each row.
-E1 = ODE.loc[:,['NN', '1E']] # Remove unnecessary OD values.
-E1.to_csv(os.path.join(pth, '1Et.csv'))
-
-
-# Find the second nearest POI for each origin node.
-fail_value = 999999999
-dupes = ODE.apply(pd.Series.duplicated, axis = 1, keep=False) # If a number is repeated within a row, value is True. If not, False.
-# The first time this is done, there should be two True values per row, unless any POIs are equidistant.
-dupes = ODE.where(~dupes, fail_value) # For any value that appears more than once in its row, it is replaced with the fail_value.
-
-ODE["2E"] = 0
-Dsub = dupes.iloc[:,1:] # Filtering out the node ID column. No need to filter 1st nearest as its new "dupes" value is too high to be caught.
-ODE["2E"] = Dsub.min(axis=1) 
-E2 = ODE.loc[:,['NN', '2E']] 
-E2.to_csv(os.path.join(pth, '2Et.csv'))
-
-
-# Find the third nearest POI for each origin node.
-dupes = ODE.apply(pd.Series.duplicated, axis = 1, keep=False)
-# Since this includes both first and second nearest columns, there should be four True values per row, unless POIs are equidistant.
-dupes = ODE.where(~dupes, fail_value)
- 
-ODE["3E"] = 0
-Dsub = dupes.iloc[:,1:] # Filtering out the node ID column.
-ODE["3E"] = Dsub.min(axis=1)
-E3 = ODE.loc[:,['NN', '3E']]
-E3.to_csv(os.path.join(pth, '3Et.csv'))
+# 1st, 2nd and 3rd nearest POI for each origin node, read from the OD store chunk by chunk.
+# A partial sort over each chunk replaces the min() / duplicated() / where() passes, and
+# equidistant POIs now each take a rank instead of being dropped. Run this for each variable.
+Eall = ao.nth_nearest_store(ODstore, listE, k = 3, label = 'E') # Minutes, NaN where there is no path.
+# One checkpoint holds all three ranks; read_checkpoint(..., ['NN', '1E']) loads just one.
 
 # Check that each row shows an increased value from the previous nearest POI.
-E1.head(5)
-E2.head(5)
-E3.head(5)
+Eall.head(5)
 
-# Save all scores to one file.
-Eall = ODE.loc[:,['NN', '1E', '2E', '3E']]
-Eall.to_csv(os.path.join(pth, 'Et.csv'))
+# Save all scores to one file. Its own checkpoint (Et_od, not Et): Et.parquet is the nearest-k
+# table written above, with the 1E_id... columns the streamed multimodal cell needs, and this
+# matrix-derived table must not silently replace it.
+Eall = Eall.loc[:,['NN', '1E', '2E', '3E']]
+ap.write_checkpoint(Eall, os.path.join(pth, 'Et_od.parquet'))
 
 
 
@@ -572,16 +472,18 @@ Create multi-modal travel times by combining walk time to road with drive time t
 
 """
 #%% If starting new session, re-load from disk.
-zwalk = os.path.join(gostNetsFolder, "SampleData", "zwalk.csv") 
-zwalk = pd.read_csv(zwalk)
-Eall = os.path.join(gostNetsFolder, "SampleData", "Et.csv")
-Eall = pd.read_csv(Eall)
+zwalk = ap.read_checkpoint(os.path.join(pth, 'zwalk.parquet'), ['wpop', 'wid', 'municipio', 'NN', 'walk_time'])
+# Et.parquet from the nearest-k cell; Et_od.parquet for the times filtered from the OD matrix.
+Eall = ap.read_checkpoint(os.path.join(pth, 'Et.parquet'), ['NN', '1E', '2E', '3E'])
 
 #%%
 zwalk.head()
 Eall.head()
-# Merge nearest POIs and walktimes
-zwalkE = zwalk.merge(Eall, how='left', left_on='NN', right_on='NN', sort=False)
+# Map each origin to its unique road node once, then gather the nearest POI times for all
+# origins in one step instead of a 1 million row merge on NN per service.
+fanout = aor.OriginFanout(zwalk.NN)
+zwalkE = zwalk.copy()
+zwalkE[['1E', '2E', '3E']] = fanout.lookup(Eall, ['1E', '2E', '3E']).values
 zwalkE.head()
 
 # Calculate walk time from WorldPop origin to nearest node.
@@ -593,4 +495,57 @@ zwalkE["mm2E"] = zwalkE["walk_time"] + zwalkE["2E"]
 zwalkE["mm3E"] = zwalkE["walk_time"] + zwalkE["3E"]
 
 
-zwalkE.to_csv(os.path.join(pth, 'Etz.csv'))
+ap.write_checkpoint(zwalkE, os.path.join(pth, 'Etz.parquet'))
+
+
+
+#%% 
+"""
+Municipal ratings
+
+"""
+# Replaces "calculate municipal ratings on GN values.R" (xtabs by xmid, one service at a time,
+# drivetime1.csv overwritten between steps): all services and ranks, drive-only (1D...) and
+# multimodal (mm1D...), in one pass over the origins, written to one table with one row per
+# municipio and variable. mean is the R script's D1 / H1 / G1 for 1D / 1H / 1G.
+zwalk = ap.read_checkpoint(os.path.join(pth, 'zwalk.parquet'), ['wpop', 'xmid', 'municipio', 'NN', 'walk_time'])
+fanout = aor.OriginFanout(zwalk.NN)
+times = {}
+for label in ['D', 'H', 'G', 'P', 'E']:
+    cols = ['1' + label, '2' + label, '3' + label]
+    drive = fanout.lookup(ap.read_checkpoint(os.path.join(pth, label + 't.parquet'), ['NN'] + cols), cols).values
+    for r in range(3):
+        times[cols[r]] = drive[:, r]
+        times['mm' + cols[r]] = zwalk['walk_time'].values + drive[:, r]
+
+# Minutes. Shares of the population beyond 30 and 60 minutes; no path counts as beyond.
+ratings = aa.MunicipalAccumulator(list(times), thresholds = (30, 60), percentiles = (50, 90))
+ratings.add(zwalk['xmid'].values, zwalk['wpop'].values, times)
+municipal = ratings.frame('xmid')
+municipal['municipio'] = municipal['xmid'].map(zwalk.groupby('xmid')['municipio'].first())
+ap.write_checkpoint(municipal, os.path.join(pth, 'municipal_ratings.parquet'))
+municipal.to_csv(os.path.join(pth, 'municipal_ratings.csv'), index = False)
+
+# Wide, as drivetime1.csv: one row per municipio, one column per variable.
+municipal.pivot(index = 'xmid', columns = 'variable', values = 'mean').head()
+
+
+#%% 
+# Or streamed, without the origin tables above (inO, inOsnap, O_elev, zwalk, zwalkE...): the
+# origins are read 100,000 at a time and each batch goes through snap, elevation, walk time,
+# the nearest-k lookup and mm1/mm2/mm3 into the same ratings, then is dropped. Only the
+# per-node tables stay in memory. Same municipal table (mm columns only).
+# access_nodes = 4: each origin may walk to any of its 4 nearest road nodes (Tobler walk time)
+# and drive on from there, keeping the best total, so a slightly farther node on a faster
+# road is used when it gets there sooner. access_nodes = 1 gives walk_time + 1E as above.
+net = an.load_network(os.path.join(pth, 'gTime_csr'))
+node_elev = net.node_table(['point_elev']).rename(columns = {'node_ID': 'NN', 'point_elev': 'node_elev'})
+snap_index = aor.load_snap_index(os.path.join(pth, 'snap_index'))
+near = {label: ap.read_checkpoint(os.path.join(pth, label + 't.parquet'),
+                                  ['NN'] + ['%d%s%s' % (r, label, s) for s in ['', '_id'] for r in [1, 2, 3]])
+        for label in ['D', 'H', 'G', 'P', 'E']}
+ratings = ap.stream_origins(os.path.join(pth, 'wpop3wgs84.shp'), snap_index, node_elev, near, pth,
+                            valid = an.component_mask(net.csr, min_nodes = 100), batch_size = 100000,
+                            out_path = os.path.join(pth, 'mm_origins.parquet'), access_nodes = 4)
+municipal = ratings.frame('xmid')
+ap.write_checkpoint(municipal, os.path.join(pth, 'municipal_ratings.parquet'))
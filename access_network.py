@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+"""
+Compact road network backend for the accessibility scripts.
+
+gTime as a NetworkX dict-of-dicts graph (171k nodes / 392k edges in Puerto Rico)
+takes gigabytes of Python objects. CSRGraph holds the same network as compressed
+sparse row arrays: int32 node indices, float32 edge times, and the osmid of each
+node index. It is saved as a folder of .npy files and loaded memory-mapped, instead
+of nx.read_gpickle("gTime.pickle").
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+class CSRGraph(object):
+    """
+    Directed graph in CSR layout. The edges leaving node index i are
+    indices[indptr[i]:indptr[i+1]] with travel times weights[indptr[i]:indptr[i+1]].
+
+    node_ids maps node index -> osmid; index_of maps osmids back to node indices.
+    x, y are the node coordinates when the source graph had them.
+    length (meters) and highway (int16 code into highway_classes, -1 if untagged) are kept
+    per edge when requested, so travel times can be rebuilt for other speed profiles.
+    edge_ids is only set on a reversed graph: position of each edge in the forward arrays.
+    Edge geometry, when the source had it (access_osm), is a pool of vertex coordinates
+    geom_x, geom_y and per edge the positions of its first and last vertex in the pool,
+    geom_start and geom_end (geom_start > geom_end: the vertices run backwards).
+    """
+
+    def __init__(self, indptr, indices, weights, node_ids, x = None, y = None, edge_ids = None,
+                 length = None, highway = None, highway_classes = None,
+                 geom_start = None, geom_end = None, geom_x = None, geom_y = None):
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.node_ids = node_ids
+        self.x = x
+        self.y = y
+        self.edge_ids = edge_ids
+        self.length = length
+        self.highway = highway
+        self.highway_classes = highway_classes
+        self.geom_start = geom_start
+        self.geom_end = geom_end
+        self.geom_x = geom_x
+        self.geom_y = geom_y
+        self._order = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    def index_of(self, osmids):
+        # Vectorized osmid -> node index. Unknown IDs get -1.
+        if self._order is None:
+            self._order = np.argsort(self.node_ids, kind = 'stable')
+        osmids = np.asarray(osmids, dtype = np.int64)
+        sorted_ids = self.node_ids[self._order]
+        pos = np.searchsorted(sorted_ids, osmids)
+        pos = np.clip(pos, 0, len(sorted_ids) - 1)
+        found = sorted_ids[pos] == osmids
+        return np.where(found, self._order[pos], -1).astype(np.int32)
+
+    def edge_sources(self):
+        # Source node index of every edge, in CSR order.
+        return np.repeat(np.arange(len(self), dtype = np.int32), np.diff(self.indptr))
+
+    def edge_weight(self, src, dst):
+        # Weight of the fastest src -> dst edge for arrays of node indices; inf where there is none.
+        src = np.asarray(src, dtype = np.int64)
+        dst = np.asarray(dst, dtype = np.int64)
+        n = len(self)
+        keys = self.edge_sources().astype(np.int64) * n + np.asarray(self.indices, dtype = np.int64)
+        order = np.lexsort((self.weights, keys)) # by key, fastest first
+        keys = keys[order]
+        want = src * n + dst
+        pos = np.clip(np.searchsorted(keys, want), 0, max(len(keys) - 1, 0))
+        out = np.full(len(want), np.inf)
+        if len(keys) > 0:
+            found = (keys[pos] == want) & (src >= 0) & (dst >= 0)
+            out[found] = np.asarray(self.weights)[order][pos[found]]
+        return out
+
+    def reverse(self):
+        # Same graph with every edge flipped, for searching from destinations back to origins.
+        sources = self.edge_sources()
+        order = np.argsort(self.indices, kind = 'stable')
+        counts = np.bincount(self.indices, minlength = len(self))
+        indptr = np.zeros(len(self) + 1, dtype = np.int32)
+        np.cumsum(counts, out = indptr[1:])
+        edge_ids = order.astype(np.int32)
+        if self.edge_ids is not None:
+            edge_ids = self.edge_ids[order]
+        return CSRGraph(indptr, sources[order], self.weights[order], self.node_ids,
+                        self.x, self.y, edge_ids,
+                        None if self.length is None else self.length[order],
+                        None if self.highway is None else self.highway[order], self.highway_classes,
+                        # A flipped edge runs along the same vertices backwards.
+                        None if self.geom_end is None else self.geom_end[order],
+                        None if self.geom_start is None else self.geom_start[order], self.geom_x, self.geom_y)
+
+    def with_weights(self, weights):
+        # Same network with other edge weights (e.g. another speed profile). Arrays are shared.
+        return CSRGraph(self.indptr, self.indices, weights, self.node_ids, self.x, self.y, self.edge_ids,
+                        self.length, self.highway, self.highway_classes,
+                        self.geom_start, self.geom_end, self.geom_x, self.geom_y)
+
+    def to_scipy(self):
+        # scipy.sparse matrix for scipy.sparse.csgraph routines (e.g. dijkstra).
+        from scipy.sparse import csr_matrix
+        n = len(self)
+        return csr_matrix((np.asarray(self.weights, dtype = np.float64), self.indices, self.indptr),
+                          shape = (n, n))
+
+
+def highway_class(tag):
+    # First entry of list-valued highway tags, as check() does in access_gn_puertorico2.py.
+    if type(tag) == list:
+        return tag[0] if len(tag) > 0 else ''
+    return '' if tag is None else tag
+
+
+def graph_to_csr(G, weight = 'time', length = None, highway = None):
+    """
+    Convert a NetworkX graph (e.g. gTime from gn.convert_network_to_time) to a CSRGraph.
+
+    Parallel edges are all kept; routing takes the fastest one. Undirected graphs get
+    an edge in each direction. Edges missing the weight attribute are dropped.
+    weight = None keeps every edge, with the length as weight (e.g. gDrive before speeds).
+    length, highway: edge attributes to keep as well (e.g. 'length' and 'highway').
+    """
+    nodes = list(G.nodes())
+    node_ids = np.asarray(nodes, dtype = np.int64)
+    index = {n: i for i, n in enumerate(nodes)}
+
+    us = []
+    vs = []
+    ws = []
+    ls = []
+    hs = []
+    for u, v, data in G.edges(data = True):
+        w = data.get(weight) if weight is not None else data.get(length, 0)
+        if w is None:
+            continue
+        us.append(index[u])
+        vs.append(index[v])
+        ws.append(w)
+        if length is not None:
+            ls.append(data.get(length, np.nan))
+        if highway is not None:
+            hs.append(highway_class(data.get(highway)))
+    us = np.asarray(us, dtype = np.int32)
+    vs = np.asarray(vs, dtype = np.int32)
+    ws = np.asarray(ws, dtype = np.float32)
+    ls = np.asarray(ls, dtype = np.float32) if length is not None else None
+    classes = codes = None
+    if highway is not None:
+        classes, codes = np.unique(np.asarray(hs, dtype = str), return_inverse = True)
+        codes = codes.ravel().astype(np.int16)
+        if '' in classes: # untagged edges get -1
+            blank = np.searchsorted(classes, '')
+            codes[codes == blank] = -1
+            codes[codes > blank] -= 1
+            classes = np.delete(classes, blank)
+    if not G.is_directed():
+        us, vs = np.concatenate([us, vs]), np.concatenate([vs, us])
+        ws = np.concatenate([ws, ws])
+        ls = None if ls is None else np.concatenate([ls, ls])
+        codes = None if codes is None else np.concatenate([codes, codes])
+
+    x = y = None
+    data = G.nodes(data = True)
+    if len(nodes) > 0 and 'x' in data[nodes[0]] and 'y' in data[nodes[0]]:
+        x = np.array([float(data[n]['x']) for n in nodes])
+        y = np.array([float(data[n]['y']) for n in nodes])
+
+    return edges_to_csr(us, vs, ws, node_ids, x, y, ls, codes, classes)
+
+
+def edges_to_csr(us, vs, ws, node_ids, x = None, y = None, length = None, highway = None, highway_classes = None,
+                 geom_start = None, geom_end = None, geom_x = None, geom_y = None):
+    # CSRGraph from edge arrays (source and target node indices, weights, optional per-edge tags
+    # and geometry, see CSRGraph).
+    order = np.argsort(us, kind = 'stable')
+    counts = np.bincount(us, minlength = len(node_ids))
+    indptr = np.zeros(len(node_ids) + 1, dtype = np.int32)
+    np.cumsum(counts, out = indptr[1:])
+    return CSRGraph(indptr, np.asarray(vs, dtype = np.int32)[order], np.asarray(ws, dtype = np.float32)[order],
+                    node_ids, x, y, None,
+                    None if length is None else length[order], None if highway is None else highway[order],
+                    highway_classes, None if geom_start is None else geom_start[order],
+                    None if geom_end is None else geom_end[order], geom_x, geom_y)
+
+
+def hdf5_to_csr(path, impedance = 'distance', twoway = None):
+    """
+    CSRGraph from a pandana network saved with Network.save_hdf5
+    (e.g. prallislands_network_allnodes.h5), weighted by one impedance column.
+
+    twoway: add the reverse of every edge. Defaults to what the file recorded (pandana's
+    default of True when it did not).
+    """
+    with pd.HDFStore(path, 'r') as store:
+        nodes = store['nodes']
+        edges = store['edges']
+        if twoway is None:
+            twoway = bool(store['two_way'].iloc[0]) if '/two_way' in store.keys() else True
+    node_ids = nodes.index.values.astype(np.int64)
+    order = np.argsort(node_ids, kind = 'stable')
+    us = order[np.searchsorted(node_ids[order], edges['from'].values.astype(np.int64))]
+    vs = order[np.searchsorted(node_ids[order], edges['to'].values.astype(np.int64))]
+    ws = edges[impedance].values
+    if twoway:
+        us, vs, ws = np.concatenate([us, vs]), np.concatenate([vs, us]), np.concatenate([ws, ws])
+    return edges_to_csr(us.astype(np.int32), vs, ws, node_ids, nodes['x'].values.astype(np.float64),
+                        nodes['y'].values.astype(np.float64))
+
+
+def nearest_nodes(csr, x, y):
+    # Node index closest to each x, y in the graph's own coordinates, as pandana's get_node_ids does.
+    from scipy.spatial import cKDTree
+    tree = cKDTree(np.column_stack([csr.x, csr.y]))
+    dist, idx = tree.query(np.column_stack([np.asarray(x, dtype = np.float64), np.asarray(y, dtype = np.float64)]))
+    return idx.astype(np.int32)
+
+
+_csr_arrays = ['indptr', 'indices', 'weights', 'node_ids', 'x', 'y', 'length', 'highway', 'highway_classes',
+               'geom_start', 'geom_end', 'geom_x', 'geom_y']
+
+
+def save_csr(csr, folder):
+    # One .npy per array, so they can be memory-mapped back in.
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for name in _csr_arrays:
+        arr = getattr(csr, name)
+        if arr is not None:
+            np.save(os.path.join(folder, name + '.npy'), np.asarray(arr))
+
+
+def load_csr(folder, mmap = True):
+    # Memory-mapped by default: nothing is read until a routine touches the arrays.
+    # Also reads the routing graph of a network artifact (save_network).
+    if os.path.exists(os.path.join(folder, 'schema.json')):
+        return load_network(folder, mmap = mmap).csr
+    mode = 'r' if mmap else None
+    arrs = {}
+    for name in _csr_arrays:
+        f = os.path.join(folder, name + '.npy')
+        arrs[name] = np.load(f, mmap_mode = mode) if os.path.exists(f) else None
+    return CSRGraph(**arrs)
+
+
+def component_mask(csr, min_nodes = 100):
+    # True for nodes in a (weakly) connected piece of the network with at least min_nodes nodes.
+    # Used to keep points from snapping to small disconnected road fragments.
+    from scipy.sparse.csgraph import connected_components
+    n_comp, labels = connected_components(csr.to_scipy(), directed = True, connection = 'weak')
+    sizes = np.bincount(labels, minlength = n_comp)
+    return sizes[labels] >= min_nodes
+
+
+def edges_touching(csr, node_mask):
+    # Boolean mask over the edges that start or end at a flagged node.
+    node_mask = np.asarray(node_mask, dtype = bool)
+    return node_mask[csr.edge_sources()] | node_mask[np.asarray(csr.indices)]
+
+
+def save_attribute(folder, name, values):
+    # Extra per-node or per-edge array (e.g. flood depth) saved next to a saved CSRGraph.
+    np.save(os.path.join(folder, 'attr_' + name + '.npy'), np.asarray(values))
+
+
+def load_attribute(folder, name, mmap = True):
+    return np.load(os.path.join(folder, 'attr_' + name + '.npy'), mmap_mode = 'r' if mmap else None)
+
+
+"""
+Speed profiles
+
+gn.convert_network_to_time walks every edge in Python each time speed_dict changes.
+With edge lengths and highway classes on the CSRGraph, travel time is one array
+operation: length / speed of the edge's class. Times for each profile are cached in the
+graph folder under a hash of the profile, so several profiles live next to one graph.
+"""
+
+def speed_times(csr, speed_dict, default = None):
+    """
+    Edge travel times in seconds for a speed profile (km/h per highway class, as speed_dict).
+
+    Classes missing from the profile, and untagged edges, use default, or the
+    'residential' speed when no default is given.
+    """
+    if default is None:
+        default = speed_dict['residential']
+    speeds = np.array([speed_dict.get(c, default) for c in csr.highway_classes] + [default],
+                      dtype = np.float64)
+    codes = np.asarray(csr.highway, dtype = np.int64)
+    kmph = speeds[np.where(codes >= 0, codes, len(speeds) - 1)]
+    return (np.asarray(csr.length, dtype = np.float64) / (kmph * 1000 / 3600)).astype(np.float32)
+
+
+def profile_key(speed_dict, default = None):
+    # Short hash of a speed profile; the same dict gives the same key in any order.
+    text = json.dumps({'speeds': sorted(speed_dict.items()), 'default': default})
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+
+def with_speeds(csr, speed_dict, folder = None, default = None):
+    """
+    The graph with travel times for a speed profile. With folder (the saved graph's folder),
+    times are read from times_<key>.npy when that profile was built before, otherwise built
+    and saved there with the profile next to them.
+    """
+    if folder is None:
+        return csr.with_weights(speed_times(csr, speed_dict, default))
+    key = profile_key(speed_dict, default)
+    f = os.path.join(folder, 'times_' + key + '.npy')
+    if os.path.exists(f):
+        return csr.with_weights(np.load(f, mmap_mode = 'r'))
+    times = speed_times(csr, speed_dict, default)
+    np.save(f, times)
+    with open(os.path.join(folder, 'times_' + key + '.json'), 'w') as fh:
+        json.dump({'speed_dict': speed_dict, 'default': default}, fh, indent = 1)
+    return csr.with_weights(times)
+
+
+"""
+Network artifact
+
+One folder per network instead of gTime.pickle plus drive_time_node.csv / drive_time_edge.csv:
+the adjacency arrays and typed node and edge columns as .npy files, and schema.json with
+the format version, the dtype, shape and sha256 of every file. Everything is memory-mapped
+on load, so a new session starts in well under a second and nothing is re-parsed or re-cast.
+"""
+
+network_version = 1
+
+_node_columns = {'node_ids': 'node_ID', 'x': 'x', 'y': 'y'}
+_edge_columns = {'weights': 'time', 'length': 'length', 'highway': 'highway',
+                 'geom_start': 'geom_start', 'geom_end': 'geom_end'}
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _save_column(folder, schema, table, name, values):
+    values = np.asarray(values)
+    if values.dtype == object:
+        values = values.astype(str)
+    rel = table + '/' + name + '.npy'
+    np.save(os.path.join(folder, table, name + '.npy'), values)
+    schema[table][name] = {'file': rel, 'dtype': values.dtype.str, 'shape': list(values.shape),
+                           'sha256': _sha256(os.path.join(folder, table, name + '.npy'))}
+
+
+def _write_schema(folder, schema):
+    tmp = os.path.join(folder, 'schema.tmp.json')
+    with open(tmp, 'w') as f:
+        json.dump(schema, f, indent = 1)
+    os.replace(tmp, os.path.join(folder, 'schema.json'))
+
+
+def save_network(folder, csr, nodes = None, edges = None, meta = None):
+    """
+    Save a CSRGraph as a versioned network artifact.
+
+    nodes, edges: extra typed columns, as a dict or DataFrame of arrays in the graph's node
+        (or CSR edge) order, e.g. {'node_elev': ...} or {'flood_depth': ...}
+    meta: anything worth recording with the network (source file, speed_dict, date)
+
+    Node osmids, x and y are stored as the node columns node_ID, x, y; edge weights, lengths
+    and highway codes as the edge columns time, length, highway. Edge geometry, when the graph
+    has it, as the edge columns geom_start, geom_end and the vertex pool geom_x, geom_y.
+    """
+    for sub in ['', 'adjacency', 'nodes', 'edges']:
+        if not os.path.exists(os.path.join(folder, sub)):
+            os.makedirs(os.path.join(folder, sub))
+    schema = {'format': 'access_network', 'version': network_version,
+              'n_nodes': len(csr), 'n_edges': csr.n_edges, 'meta': meta or {},
+              'adjacency': {}, 'nodes': {}, 'edges': {}}
+    for name in ['indptr', 'indices']:
+        _save_column(folder, schema, 'adjacency', name, getattr(csr, name))
+    for name in ['highway_classes', 'geom_x', 'geom_y']:
+        if getattr(csr, name) is not None:
+            _save_column(folder, schema, 'adjacency', name, getattr(csr, name))
+    for attr, name in _node_columns.items():
+        if getattr(csr, attr) is not None:
+            _save_column(folder, schema, 'nodes', name, getattr(csr, attr))
+    for attr, name in _edge_columns.items():
+        if getattr(csr, attr) is not None:
+            _save_column(folder, schema, 'edges', name, getattr(csr, attr))
+    for table, cols, n in [('nodes', nodes, len(csr)), ('edges', edges, csr.n_edges)]:
+        for name in ([] if cols is None else list(cols.keys())):
+            values = np.asarray(cols[name])
+            if len(values) != n:
+                raise ValueError('%s column %s has %d rows, expected %d' % (table, name, len(values), n))
+            _save_column(folder, schema, table, name, values)
+    _write_schema(folder, schema)
+    return load_network(folder)
+
+
+def add_network_column(folder, table, name, values):
+    # Add or replace one node or edge column of a saved network (e.g. node elevation).
+    net = load_network(folder)
+    n = net.schema['n_nodes'] if table == 'nodes' else net.schema['n_edges']
+    if len(values) != n:
+        raise ValueError('%s column %s has %d rows, expected %d' % (table, name, len(values), n))
+    schema = net.schema
+    _save_column(folder, schema, table, name, values)
+    _write_schema(folder, schema)
+
+
+class Network(object):
+    """
+    A loaded network artifact. csr is the routing graph; node and edge columns are
+    memory-mapped arrays, turned into DataFrames only when asked for.
+    """
+
+    def __init__(self, folder, schema, columns):
+        self.folder = folder
+        self.schema = schema
+        self.columns = columns
+        adj = columns['adjacency']
+        nodes = columns['nodes']
+        edges = columns['edges']
+        self.csr = CSRGraph(adj['indptr'], adj['indices'], edges.get('time'), nodes['node_ID'],
+                            nodes.get('x'), nodes.get('y'), None, edges.get('length'), edges.get('highway'),
+                            adj.get('highway_classes'), edges.get('geom_start'), edges.get('geom_end'),
+                            adj.get('geom_x'), adj.get('geom_y'))
+
+    def node_table(self, columns = None):
+        # node_ID, x, y and the other node columns (or only the ones listed), in node index order.
+        nodes = self.columns['nodes']
+        names = list(nodes) if columns is None else ['node_ID'] + [c for c in columns if c != 'node_ID']
+        return pd.DataFrame({c: np.asarray(nodes[c]) for c in names})
+
+    def edge_table(self, columns = None, geometry = False):
+        """
+        u, v (node osmids) and the edge columns, in CSR edge order. highway is given as the
+        class name. With geometry, each edge gets its road geometry (shapely) when the network
+        has it (built with access_osm). Otherwise it gets a straight line between its end nodes,
+        which is only an approximation: it cuts across the curves of long rural edges.
+        """
+        edges = self.columns['edges']
+        csr = self.csr
+        out = pd.DataFrame({'u': csr.node_ids[csr.edge_sources()], 'v': csr.node_ids[np.asarray(csr.indices)]})
+        default = [c for c in edges if c not in ('geom_start', 'geom_end')]
+        for c in (default if columns is None else columns):
+            if c == 'highway' and csr.highway_classes is not None:
+                codes = np.asarray(edges[c])
+                out[c] = np.append(csr.highway_classes, '')[np.where(codes >= 0, codes, len(csr.highway_classes))]
+            else:
+                out[c] = np.asarray(edges[c])
+        if geometry:
+            out['geometry'] = edge_geometry(csr)
+        return out
+
+
+def edge_geometry(csr):
+    # Shapely linestring of every edge in CSR edge order: the road geometry when the graph has
+    # it, otherwise a straight line between the end nodes.
+    import shapely
+    if csr.geom_start is None:
+        src = csr.edge_sources()
+        dst = np.asarray(csr.indices)
+        coords = np.stack([np.stack([csr.x[src], csr.y[src]], axis = 1),
+                           np.stack([csr.x[dst], csr.y[dst]], axis = 1)], axis = 1)
+        return shapely.linestrings(coords)
+    start = np.asarray(csr.geom_start, dtype = np.int64)
+    end = np.asarray(csr.geom_end, dtype = np.int64)
+    step = np.where(end >= start, 1, -1)
+    n = np.abs(end - start) + 1
+    edge = np.repeat(np.arange(len(start)), n)
+    first = np.zeros(len(n), dtype = np.int64)
+    np.cumsum(n[:-1], out = first[1:])
+    pos = start[edge] + step[edge] * (np.arange(len(edge)) - first[edge])
+    coords = np.column_stack([np.asarray(csr.geom_x)[pos], np.asarray(csr.geom_y)[pos]])
+    return shapely.linestrings(coords, indices = edge)
+
+
+def verify_network(folder):
+    # Recompute every checksum. Raises ValueError naming the first file that does not match.
+    with open(os.path.join(folder, 'schema.json')) as f:
+        schema = json.load(f)
+    for table in ['adjacency', 'nodes', 'edges']:
+        for name, spec in schema[table].items():
+            if _sha256(os.path.join(folder, spec['file'])) != spec['sha256']:
+                raise ValueError('checksum mismatch: %s' % spec['file'])
+    return True
+
+
+def load_network(folder, verify = False, mmap = True):
+    """
+    Load a network artifact saved with save_network. Arrays are memory-mapped unless mmap is False.
+    verify recomputes the checksums first (reads every file, so it takes a few seconds).
+    """
+    with open(os.path.join(folder, 'schema.json')) as f:
+        schema = json.load(f)
+    if schema.get('format') != 'access_network':
+        raise ValueError('%s is not a network artifact' % folder)
+    if schema['version'] > network_version:
+        raise ValueError('network artifact version %d is newer than this code (%d)'
+                         % (schema['version'], network_version))
+    if verify:
+        verify_network(folder)
+    mode = 'r' if mmap else None
+    columns = {}
+    for table in ['adjacency', 'nodes', 'edges']:
+        columns[table] = {}
+        for name, spec in schema[table].items():
+            arr = np.load(os.path.join(folder, spec['file']), mmap_mode = mode)
+            if arr.dtype.str != spec['dtype'] or list(arr.shape) != spec['shape']:
+                raise ValueError('%s does not match the schema' % spec['file'])
+            columns[table][name] = arr
+    return Network(folder, schema, columns)
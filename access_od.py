@@ -0,0 +1,1006 @@
+# -*- coding: utf-8 -*-
+"""
+Routing helpers for the Puerto Rico accessibility scripts.
+
+gn.calculate_OD builds the full origin x destination matrix (141,873 x 2,700 for
+the five services) only for the nth nearest filter to throw almost all of it away.
+The nearest-k search below runs outward from a category's snapped destination
+nodes over the reversed time graph instead, keeping only the k best
+(time, facility) labels per road node. One sweep per service category.
+
+Times are in the units of the graph weight (seconds for gTime). Every routine takes
+either a NetworkX graph or an access_network.CSRGraph; the CSR form is much faster.
+"""
+
+import os
+import json
+import time
+import heapq
+import warnings
+import numpy as np
+import pandas as pd
+import access_network as an
+
+fail_value = 999999999 # Same convention as gn.calculate_OD: no path gets the fail value.
+
+
+def _k_nearest_search(indptr, indices, weights, seeds, k, cutoff = None, fail_value = fail_value,
+                      times = None, labels = None, preds = None, active = None):
+    # Multi-source Dijkstra keeping up to k labels per node, each from a different source.
+    # seeds is a list of (time, node index, source label, edge index or -1). A node is final
+    # once it holds k labels, and a label is only pushed on to a neighbour that has not seen
+    # that source yet. If a source is among the k nearest of a node, it is among the k nearest
+    # of every node on the shortest path between them, so pruning this way stays exact.
+    # preds records the edge each label arrived by, so the shortest-path trees can be walked later.
+    # With active (a boolean list over nodes), only active nodes are settled; the given
+    # times/labels/preds of the other nodes are kept as they are.
+    n = len(indptr) - 1
+    if cutoff is None:
+        cutoff = np.inf
+    if times is None:
+        times = np.full((n, k), fail_value, dtype = np.float64)
+        labels = np.full((n, k), -1, dtype = np.int64)
+        preds = np.full((n, k), -1, dtype = np.int32)
+    count = [0] * n
+    seen = [None] * n
+    if active is not None:
+        # Inactive nodes are final: mark them full so nothing is pushed onto them.
+        count = [0 if a else k for a in active]
+
+    heap = list(seeds)
+    heapq.heapify(heap)
+    while heap:
+        d, v, f, e = heapq.heappop(heap)
+        c = count[v]
+        if c >= k:
+            continue
+        s = seen[v]
+        if s is None:
+            s = seen[v] = set()
+        elif f in s:
+            continue
+        s.add(f)
+        times[v, c] = d
+        labels[v, c] = f
+        preds[v, c] = e
+        count[v] = c + 1
+
+        for j in range(indptr[v], indptr[v + 1]):
+            w = weights[j]
+            if w >= fail_value: # Edge disrupted (gn.disrupt_network sets time to the fail value).
+                continue
+            u = indices[j]
+            if count[u] >= k:
+                continue
+            du = d + w
+            if du > cutoff:
+                continue
+            su = seen[u]
+            if su is not None and f in su:
+                continue
+            heapq.heappush(heap, (du, u, f, j))
+
+    return times, labels, preds
+
+
+def as_csr(G, weight = 'time'):
+    # Routines here run on CSR arrays. Convert NetworkX graphs on the fly.
+    if isinstance(G, an.CSRGraph):
+        return G
+    return an.graph_to_csr(G, weight)
+
+
+class KNearest(object):
+    """
+    Result of a nearest-k search, kept as arrays over the graph's node index:
+    times (n x k, fail value where missing), labels (position in dest_ids, -1 where missing)
+    and preds (index of the reversed-graph edge each label arrived by, -1 at a destination).
+    preds make up the shortest-path trees, which disrupt() uses to find what a blockage touches.
+    missing: the destination IDs that are not nodes of the graph (never reached).
+    """
+
+    def __init__(self, node_ids, dest_ids, times, labels, preds, cutoff = None, fail_value = fail_value,
+                 missing = None):
+        self.node_ids = np.asarray(node_ids)
+        self.dest_ids = np.asarray(dest_ids, dtype = np.int64)
+        self.times = times
+        self.labels = labels
+        self.preds = preds
+        self.cutoff = cutoff
+        self.fail_value = fail_value
+        self.missing = np.zeros(0, dtype = np.int64) if missing is None else np.asarray(missing, dtype = np.int64)
+
+    @property
+    def k(self):
+        return self.times.shape[1]
+
+    def ids(self):
+        # Destination node ID of each label, -1 where missing.
+        return np.append(self.dest_ids, -1)[self.labels]
+
+    def frame(self, label = ''):
+        # DataFrame as returned by nearest_k.
+        out = pd.DataFrame({'NN': self.node_ids})
+        for r in range(self.k):
+            out['%d%s' % (r + 1, label)] = self.times[:, r]
+        ids = self.ids()
+        for r in range(self.k):
+            out['%d%s_id' % (r + 1, label)] = ids[:, r]
+        return out
+
+    def copy(self):
+        return KNearest(self.node_ids, self.dest_ids, self.times.copy(), self.labels.copy(),
+                        self.preds.copy(), self.cutoff, self.fail_value, self.missing)
+
+    def save(self, f):
+        # The baseline trees, e.g. to run disruption scenarios in a later session.
+        np.savez(f, node_ids = self.node_ids, dest_ids = self.dest_ids, times = self.times,
+                 labels = self.labels, preds = self.preds,
+                 cutoff = np.inf if self.cutoff is None else self.cutoff, fail_value = self.fail_value,
+                 missing = self.missing)
+
+
+def load_knearest(f):
+    arrs = np.load(f)
+    cutoff = float(arrs['cutoff'])
+    return KNearest(arrs['node_ids'], arrs['dest_ids'], arrs['times'], arrs['labels'], arrs['preds'],
+                    None if np.isinf(cutoff) else cutoff, float(arrs['fail_value']),
+                    arrs['missing'] if 'missing' in arrs.files else None)
+
+
+def nearest_k_search(G, dests, k = 3, weight = 'time', cutoff = None, fail_value = fail_value):
+    # nearest_k, returning the KNearest arrays (with the shortest-path trees) instead of a DataFrame.
+    csr = as_csr(G, weight)
+    rev = csr.reverse()
+    dests = pd.unique(pd.Series(list(dests)).dropna()).astype(np.int64)
+    idx = csr.index_of(dests)
+    missing = dests[idx < 0]
+    if len(missing) > 0:
+        warnings.warn('%d destinations are not nodes of the graph and are left out (KNearest.missing): %s'
+                      % (len(missing), list(missing[:10])))
+    seeds = [(0.0, int(i), f, -1) for f, i in enumerate(idx) if i >= 0]
+
+    times, labels, preds = _k_nearest_search(rev.indptr.tolist(), rev.indices.tolist(), rev.weights.tolist(),
+                                             seeds, k, cutoff, fail_value)
+    return KNearest(csr.node_ids, dests, times, labels, preds, cutoff, fail_value, missing)
+
+
+def nearest_k(G, dests, k = 3, weight = 'time', cutoff = None, label = '', fail_value = fail_value):
+    """
+    Travel time from every node of G to its k nearest destinations.
+
+    G: CSRGraph, or graph with a travel time attribute on each edge (e.g. gTime)
+    dests: node IDs the destinations snapped to (e.g. inDsnap.NN). Duplicates are
+        dropped, so two facilities on the same road node count once, as in calculate_OD.
+    k: how many nearest destinations to keep per node
+    cutoff: stop searching beyond this time. Nodes further away get the fail value.
+    label: suffix for the output columns, e.g. 'D' gives 1D, 2D, 3D
+
+    Returns a DataFrame with one row per node: NN, the k times (1<label>...) and the
+    node ID of the destination each time leads to (1<label>_id...). Missing ranks get
+    the fail value and an ID of -1.
+    """
+    return nearest_k_search(G, dests, k, weight, cutoff, fail_value).frame(label)
+
+
+def nearest_pois(G, x, y, distance, num_pois = 1, poi_ids = None, include_poi_ids = False,
+                 fail_value = fail_value):
+    """
+    pandana's set_pois + nearest_pois, without network.precompute.
+
+    G: CSRGraph in the coordinates of x, y (e.g. an.hdf5_to_csr of the pandana .h5)
+    x, y: POI coordinates; each POI is placed on its closest node (an.nearest_nodes)
+    distance: search radius, in the graph's weight units (meters for pandana's 'distance')
+    num_pois: how many POIs to keep per node. Each POI counts once, even when several
+        share a node, as in pandana.
+
+    pandana precomputes, for every node, all nodes within distance, which grows with
+    the square of the radius (timed out at 25 km). Nothing is precomputed or kept between
+    calls here: every call runs one search outward from all POIs at once, which settles each
+    node at most num_pois times and stops at distance. Its time still grows with the radius
+    until every node has num_pois POIs in range. Measured on a 302,500-node grid (100 m edges,
+    50 POIs, num_pois = 5): 1.0 s at 1 km, 9.0 s at 10 km, 15.7 s at 40 km.
+
+    Returns a DataFrame indexed by node ID with columns 1..num_pois, the distance to each
+    nearest POI, or distance where fewer POIs are in range (pandana's fill). With
+    include_poi_ids, also poi1..poi<num_pois> with the POI IDs (index of poi_ids, NaN if none).
+    """
+    csr = as_csr(G)
+    rev = csr.reverse()
+    x = np.asarray(x, dtype = np.float64)
+    y = np.asarray(y, dtype = np.float64)
+    at = an.nearest_nodes(csr, x, y)
+    seeds = [(0.0, int(i), f, -1) for f, i in enumerate(at)]
+    times, labels, preds = _k_nearest_search(rev.indptr.tolist(), rev.indices.tolist(), rev.weights.tolist(),
+                                             seeds, num_pois, distance, fail_value)
+    out = pd.DataFrame(np.where(times < fail_value, times, distance), index = pd.Index(csr.node_ids, name = 'id'),
+                       columns = range(1, num_pois + 1))
+    if include_poi_ids:
+        ids = np.asarray(poi_ids) if poi_ids is not None else np.arange(len(x))
+        ids = np.append(ids.astype(np.float64), np.nan)
+        for r in range(num_pois):
+            out['poi%d' % (r + 1)] = ids[labels[:, r]]
+    return out
+
+
+def _category_search(indptr, indices, weights, seeds, n_groups, k, cutoff = None, fail_value = fail_value):
+    # _k_nearest_search with k labels per node for each group (category) of sources, in one
+    # sweep. seeds are (time, node index, source label, group). A node is final for a group
+    # once it holds k labels of that group, and labels of that group are no longer pushed
+    # onto it; the pruning stays exact group by group, as in _k_nearest_search.
+    n = len(indptr) - 1
+    if cutoff is None:
+        cutoff = np.inf
+    # Flat lists while searching (faster to set one item than numpy), arrays at the end.
+    times = [fail_value] * (n * n_groups * k)
+    labels = [-1] * (n * n_groups * k)
+    count = [0] * (n * n_groups)
+    seen = [None] * n
+
+    heap = list(seeds)
+    heapq.heapify(heap)
+    while heap:
+        d, v, f, g = heapq.heappop(heap)
+        vg = v * n_groups + g
+        c = count[vg]
+        if c >= k:
+            continue
+        s = seen[v]
+        if s is None:
+            s = seen[v] = set()
+        elif f in s:
+            continue
+        s.add(f)
+        times[vg * k + c] = d
+        labels[vg * k + c] = f
+        count[vg] = c + 1
+
+        for j in range(indptr[v], indptr[v + 1]):
+            w = weights[j]
+            if w >= fail_value:
+                continue
+            u = indices[j]
+            if count[u * n_groups + g] >= k:
+                continue
+            du = d + w
+            if du > cutoff:
+                continue
+            su = seen[u]
+            if su is not None and f in su:
+                continue
+            heapq.heappush(heap, (du, u, f, g))
+
+    return (np.array(times, dtype = np.float64).reshape(n, n_groups, k),
+            np.array(labels, dtype = np.int64).reshape(n, n_groups, k))
+
+
+def nearest_pois_by_category(G, x, y, category, distance, num_pois = 1, poi_ids = None,
+                             include_poi_ids = False, fail_value = fail_value):
+    """
+    nearest_pois for several POI categories at once (e.g. dialysis, hospitals, gas,
+    pharmacies, schools), instead of one set_pois + nearest_pois per category.
+
+    x, y, category: one row per POI (e.g. the columns of a table of all amenities)
+
+    All categories are searched in the same sweep over the network, which is reversed and
+    snapped to once; each node is settled at most num_pois times per category. That takes
+    about as long as one nearest_pois call per category (10.5 s against 9.1 s for five
+    categories of 10 POIs at 10 km, on the grid measured in nearest_pois).
+
+    Returns a DataFrame indexed by node ID with columns (category, 1..num_pois), so that
+    out['school'] is what nearest_pois gives for the schools alone (same fill of distance).
+    out.values is the single wide array, nodes x (categories * ranks), category by category.
+    With include_poi_ids, also (category, poi1..poi<num_pois>) with the POI IDs.
+    """
+    csr = as_csr(G)
+    rev = csr.reverse()
+    x = np.asarray(x, dtype = np.float64)
+    y = np.asarray(y, dtype = np.float64)
+    groups, names = pd.factorize(np.asarray(category))
+    at = an.nearest_nodes(csr, x, y)
+    seeds = [(0.0, int(i), f, int(groups[f])) for f, i in enumerate(at) if groups[f] >= 0]
+    times, labels = _category_search(rev.indptr.tolist(), rev.indices.tolist(), rev.weights.tolist(),
+                                     seeds, len(names), num_pois, distance, fail_value)
+    ranks = list(range(1, num_pois + 1))
+    wide = np.where(times < fail_value, times, distance)
+    if include_poi_ids:
+        ids = np.asarray(poi_ids) if poi_ids is not None else np.arange(len(x))
+        ids = np.append(ids.astype(np.float64), np.nan)
+        ranks += ['poi%d' % (r + 1) for r in range(num_pois)]
+        wide = np.concatenate([wide, ids[labels]], axis = 2)
+    out = pd.DataFrame(wide.reshape(len(wide), -1), index = pd.Index(csr.node_ids, name = 'id'),
+                       columns = pd.MultiIndex.from_product([list(names), ranks]))
+    return out
+
+
+"""
+Incremental disruption
+
+gn.disrupt_network only sets a few edges to the fail value (117 for the 0.45 m flood),
+yet the notebook reran calculate_OD for every origin and destination. Starting from the
+baseline shortest-path trees (KNearest.preds), only the labels whose path to the facility
+crosses a blocked edge are affected. Blocking can only make trips longer, so every other
+node keeps its k nearest, and the search is rerun over the affected nodes only, seeded
+from their unaffected neighbours.
+"""
+
+def affected_labels(result, rev, blocked):
+    """
+    Boolean n x k mask of the labels whose shortest path uses a blocked edge.
+
+    rev: the reversed CSRGraph the result was computed on (csr.reverse())
+    blocked: boolean mask over the reversed graph's edges
+    """
+    n, k = result.times.shape
+    has = result.labels >= 0
+    pred = result.preds
+    aff = has & (pred >= 0) & blocked[np.maximum(pred, 0)]
+
+    # Parent label: same destination, at the node the pred edge came from.
+    sources = rev.edge_sources()
+    parent_node = np.where(pred >= 0, sources[np.maximum(pred, 0)], np.arange(n)[:, None])
+    match = result.labels[parent_node] == result.labels[:, :, None]
+    parent_rank = np.argmax(match, axis = 2)
+    parent = (parent_node * k + parent_rank).ravel()
+    parent[~has.ravel()] = np.flatnonzero(~has.ravel())
+
+    # Pointer jumping: a label is affected if any label up its tree is, in log(depth) steps.
+    aff = aff.ravel()
+    while True:
+        new = aff | aff[parent]
+        parent2 = parent[parent]
+        if (new == aff).all() and (parent2 == parent).all():
+            break
+        aff = new
+        parent = parent2
+    return aff.reshape(n, k)
+
+
+def disrupt(result, G, blocked_edges = None, blocked_nodes = None, weight = 'time'):
+    """
+    Nearest-k after a disruption, recomputing only what the blockage touches.
+
+    result: KNearest from nearest_k_search on the graph before the disruption (baseline, or
+        a smaller disruption: blockages only need to be added on top of what result had)
+    G: the same CSRGraph (not modified)
+    blocked_edges: boolean mask over G's edges (CSR order) that can no longer be used
+    blocked_nodes: boolean mask over G's nodes; every edge touching one is blocked, as
+        gn.disrupt_network does for nodes above the flood threshold
+
+    Returns (new KNearest, boolean mask of the nodes that were recomputed).
+    """
+    csr = as_csr(G, weight)
+    rev = csr.reverse()
+    n, k = result.times.shape
+    fwd_blocked = np.zeros(csr.n_edges, dtype = bool) if blocked_edges is None else \
+        np.asarray(blocked_edges, dtype = bool).copy()
+    if blocked_nodes is not None:
+        fwd_blocked |= an.edges_touching(csr, blocked_nodes)
+    blocked = fwd_blocked[rev.edge_ids]
+
+    aff = affected_labels(result, rev, blocked)
+    redo = aff.any(axis = 1)
+    out = result.copy()
+    if not redo.any():
+        return out, redo
+
+    # Clear the affected nodes; everything else is final.
+    out.times[redo] = result.fail_value
+    out.labels[redo] = -1
+    out.preds[redo] = -1
+
+    weights = np.asarray(rev.weights, dtype = np.float64).copy()
+    weights[blocked] = result.fail_value
+    indptr = np.asarray(rev.indptr)
+    indices = np.asarray(rev.indices)
+    cutoff = np.inf if result.cutoff is None else result.cutoff
+
+    # Seeds: destinations on affected nodes, and the labels of unaffected nodes one edge away.
+    dest_idx = csr.index_of(result.dest_ids)
+    seeds = [(0.0, int(i), f, -1) for f, i in enumerate(dest_idx) if i >= 0 and redo[i]]
+    sources = rev.edge_sources()
+    cross = np.flatnonzero(~redo[sources] & redo[indices] & (weights < result.fail_value))
+    for r in range(k):
+        lab = result.labels[sources[cross], r]
+        t = result.times[sources[cross], r] + weights[cross]
+        ok = (lab >= 0) & (t <= cutoff)
+        seeds.extend(zip(t[ok].tolist(), indices[cross][ok].tolist(), lab[ok].tolist(), cross[ok].tolist()))
+
+    _k_nearest_search(indptr.tolist(), indices.tolist(), weights.tolist(), seeds, k, result.cutoff,
+                      result.fail_value, out.times, out.labels, out.preds, redo.tolist())
+    return out, redo
+
+
+def _origin_times(result, fanout):
+    # Nearest-k times for every origin (rows of fanout), or per node without a fanout.
+    if fanout is None:
+        return result.times
+    node_idx = _positions(result.node_ids, fanout.nodes)
+    rows = np.where(fanout.index >= 0, node_idx[np.maximum(fanout.index, 0)], -1)
+    out = np.full((len(rows), result.k), result.fail_value)
+    out[rows >= 0] = result.times[rows[rows >= 0]]
+    return out
+
+
+def _positions(node_ids, osmids):
+    # Position of each osmid in node_ids, -1 where missing.
+    order = np.argsort(node_ids, kind = 'stable')
+    pos = np.clip(np.searchsorted(node_ids[order], osmids), 0, max(len(node_ids) - 1, 0))
+    return np.where(node_ids[order][pos] == osmids, order[pos], -1)
+
+
+def flood_sweep(result, G, depth, thresholds, fanout = None, pop = None, label = '', keep = False,
+                verbose = False):
+    """
+    Disruption for a list of flood-depth thresholds in one pass over one graph.
+
+    result: baseline KNearest (nearest_k_search on the undisrupted graph)
+    G: the CSRGraph it was computed on; not copied or modified
+    depth: flood depth per node, aligned with G's node index (e.g. from gn.sample_raster).
+        NaN counts as not flooded. Edges touching a node deeper than the threshold are
+        blocked, as in gn.disrupt_network.
+    thresholds: flood depths to test. They are run from highest to lowest: each lower
+        threshold blocks a superset of the nodes, so every step starts from the last one
+        and only recomputes what the newly flooded nodes touch.
+    fanout: aor.OriginFanout of the origins, to count trips per origin rather than per node
+    pop: weight per origin (e.g. wpop), or per node without a fanout. Default 1.
+    keep: also return the KNearest of each threshold
+    verbose: print the nodes blocked and recomputed and the time taken for each threshold
+
+    Returns a DataFrame with one row per threshold (in the order given): blocked_nodes,
+    recomputed (nodes searched again), impossible_trips (origin x rank among the k nearest with
+    no path, not a count over the full OD matrix), impossible_pop (population with no path to
+    the 1st nearest), and for each rank r the change in
+    population-weighted mean time (minutes) over origins that still reach it, d<r><label>.
+    """
+    depth = np.nan_to_num(np.asarray(depth, dtype = np.float64), nan = 0.0)
+    base = _origin_times(result, fanout)
+    pop = np.ones(len(base)) if pop is None else np.asarray(pop, dtype = np.float64)
+    fail = result.fail_value
+
+    rows = {}
+    results = {}
+    state = result
+    for t in sorted(set(thresholds), reverse = True):
+        start = time.time()
+        blocked = depth > t
+        state, redo = disrupt(state, G, blocked_nodes = blocked)
+        times = _origin_times(state, fanout)
+        row = {'threshold': t, 'blocked_nodes': int(blocked.sum()), 'recomputed': int(redo.sum())}
+        lost = times >= fail
+        row['impossible_trips'] = int(lost.sum())
+        row['impossible_pop'] = float(pop[lost[:, 0]].sum())
+        for r in range(result.k):
+            ok = (base[:, r] < fail) & ~lost[:, r]
+            w = pop[ok]
+            if w.sum() > 0:
+                row['d%d%s' % (r + 1, label)] = float((w * (times[ok, r] - base[ok, r])).sum() / w.sum() / 60)
+            else:
+                row['d%d%s' % (r + 1, label)] = np.nan
+        rows[t] = row
+        if keep:
+            results[t] = state
+        if verbose:
+            print('threshold %s: %d nodes blocked, %d recomputed, %.1f seconds' % (t, row['blocked_nodes'],
+                                                                               row['recomputed'], time.time() - start))
+
+    out = pd.DataFrame([rows[t] for t in thresholds])
+    if keep:
+        return out, results
+    return out
+
+
+def nth_nearest(block, k = 3, fail_value = fail_value, columns = None):
+    """
+    The k smallest times in each row of an OD block, and the column each came from.
+
+    block: 2D array or DataFrame (rows origins, columns destinations). NaN and anything
+        at or above fail_value count as no path.
+    columns: destination IDs for the columns (default: the DataFrame columns, or positions)
+
+    Uses a partial sort over the whole block at once, instead of min() then
+    apply(pd.Series.duplicated)/where() for every rank. Equidistant destinations each
+    take their own rank. Returns (times, ids), both n x k; ranks with no path get NaN
+    and an ID of -1.
+    """
+    if isinstance(block, pd.DataFrame):
+        if columns is None:
+            columns = block.columns.values
+        block = block.values
+    vals = np.array(block, dtype = np.float64)
+    vals[~(vals < fail_value)] = np.inf # Also catches NaN.
+    n, m = vals.shape
+    if columns is None:
+        columns = np.arange(m)
+    columns = np.append(np.asarray(columns), -1)
+
+    kk = min(k, m)
+    if kk < m:
+        idx = np.argpartition(vals, kk - 1, axis = 1)[:, :kk]
+    else:
+        idx = np.tile(np.arange(m), (n, 1))
+    part = np.take_along_axis(vals, idx, axis = 1)
+    order = np.argsort(part, axis = 1, kind = 'stable')
+    idx = np.take_along_axis(idx, order, axis = 1)
+    part = np.take_along_axis(part, order, axis = 1)
+
+    times = np.full((n, k), np.nan)
+    ids = np.full((n, k), -1, dtype = columns.dtype)
+    found = np.isfinite(part)
+    times[:, :kk] = np.where(found, part, np.nan)
+    ids[:, :kk] = np.where(found, columns[idx], -1)
+    return times, ids
+
+
+def nth_nearest_store(store, dests, k = 3, label = '', minutes = True, chunk_rows = 10000):
+    """
+    nth_nearest over an ODStore, one chunk of rows at a time, for one category of destinations
+    (e.g. listE). Returns a DataFrame like nearest_k: NN, 1<label>..k<label> and the
+    destination node IDs 1<label>_id... Times in minutes with NaN for no path if minutes.
+    """
+    times = []
+    ids = []
+    for rows, block in store.iter_chunks(dests, chunk_rows):
+        t, i = nth_nearest(block, k, store.fail_value, columns = np.asarray(dests))
+        times.append(t)
+        ids.append(i)
+    times = np.concatenate(times) if times else np.zeros((0, k))
+    ids = np.concatenate(ids) if ids else np.zeros((0, k), dtype = np.int64)
+    if minutes:
+        times = times / 60
+
+    out = pd.DataFrame({'NN': store.origins})
+    for r in range(k):
+        out['%d%s' % (r + 1, label)] = times[:, r]
+    for r in range(k):
+        out['%d%s_id' % (r + 1, label)] = ids[:, r]
+    return out
+
+
+def merge_candidates(times, ids, k = 3, fail_value = fail_value):
+    """
+    k best distinct destinations per row from several candidate (time, destination ID) pairs.
+
+    times, ids: n x m arrays, e.g. the nearest-k lists of every road node an origin can reach
+        first, each already offset by the cost of getting to that node. ID -1 is no candidate.
+    Returns (times, ids), n x k, fail value and -1 where there are fewer than k destinations.
+    """
+    times = np.array(times, dtype = np.float64)
+    ids = np.asarray(ids)
+    n, m = times.shape
+    times[(ids < 0) | ~(times < fail_value)] = np.inf
+
+    # Keep only the fastest candidate for each destination in a row.
+    rows = np.repeat(np.arange(n), m)
+    order = np.lexsort((times.ravel(), ids.ravel(), rows))
+    flat_ids = ids.ravel()[order]
+    flat_rows = rows[order]
+    first = np.ones(len(order), dtype = bool)
+    first[1:] = (flat_ids[1:] != flat_ids[:-1]) | (flat_rows[1:] != flat_rows[:-1])
+    dup = np.zeros(n * m, dtype = bool)
+    dup[order[~first]] = True
+    times.ravel()[dup] = np.inf
+
+    best, best_ids = nth_nearest(times, k, fail_value, columns = None)
+    best_ids = np.where(best_ids >= 0, np.take_along_axis(ids, np.maximum(best_ids, 0), axis = 1), -1)
+    best = np.where(np.isnan(best), fail_value, best)
+    return best, best_ids
+
+
+def nearest_from_edges(G, snapped, near, k = 3, label = '', fail_value = fail_value):
+    """
+    Nearest-k destinations for points snapped to edges (access_origins.snap_to_edges), routing
+    from a virtual node on the edge without adding it to the graph.
+
+    From the point you drive on to v (time_v), or back to u when the road runs both ways
+    (the share of the v -> u edge time). The point's k nearest are the k best distinct
+    destinations among both end nodes' nearest-k lists plus those offsets.
+
+    G: the CSRGraph (or NetworkX graph) near was computed on
+    near: output of nearest_k with the same label
+    Returns a DataFrame aligned with snapped: 1<label>..k<label> and 1<label>_id...
+    """
+    csr = as_csr(G)
+    u = csr.index_of(snapped['edge_u'].values)
+    v = csr.index_of(snapped['edge_v'].values)
+    time_v = snapped['time_v'].values.astype(np.float64)
+    with np.errstate(invalid = 'ignore'):
+        frac = np.where(snapped['time_u'].values + time_v > 0,
+                        snapped['time_u'].values / (snapped['time_u'].values + time_v), 0.0)
+    time_u = frac * csr.edge_weight(v, u) # inf on one-way roads
+
+    # Node nearest-k lists in node index order.
+    rank_cols = ['%d%s' % (r + 1, label) for r in range(k)]
+    id_cols = ['%d%s_id' % (r + 1, label) for r in range(k)]
+    pos = csr.index_of(near['NN'].values)
+    T = np.full((len(csr) + 1, k), np.inf) # last row: no node
+    I = np.full((len(csr) + 1, k), -1, dtype = np.int64)
+    T[pos[pos >= 0]] = near[rank_cols].values[pos >= 0]
+    I[pos[pos >= 0]] = near[id_cols].values[pos >= 0]
+
+    times = np.concatenate([time_v[:, None] + T[v], time_u[:, None] + T[u]], axis = 1)
+    ids = np.concatenate([I[v], I[u]], axis = 1)
+    best, best_ids = merge_candidates(times, ids, k, fail_value)
+
+    out = pd.DataFrame(index = snapped.index)
+    for r in range(k):
+        out[rank_cols[r]] = best[:, r]
+    for r in range(k):
+        out[id_cols[r]] = best_ids[:, r]
+    return out
+
+
+def nearest_multimodal(near, nodes, walk, k = 3, label = '', fail_value = fail_value):
+    """
+    Nearest-k destinations by total walk + drive time, choosing the road node to walk to.
+
+    mm1E = walk_time + 1E only lets an origin use its nearest node, even when a slightly
+    farther node on a faster road gets there sooner. Here every origin has several first-leg
+    candidates: walking to each of its nearest road nodes (access_origins.snap_candidates,
+    with Tobler walk times), then driving on from that node's nearest-k list. The k best
+    distinct destinations over all candidates are the origin's multimodal nearest k. The
+    per-node lists come from the one search run outward from the destinations, so this is
+    a gather and a partial sort per origin, not a search.
+
+    near: output of nearest_k with the same label and k (times in the units of walk, e.g.
+        minutes, NaN or fail value where there is no path; the 1<label>_id... columns are needed)
+    nodes: n x m node IDs each origin can walk to (-1 for none)
+    walk: n x m walk times to those nodes (NaN where the walk is unknown)
+    Returns a DataFrame with one row per origin: mm1<label>..mmk<label>, the total times
+    (fail value where no destination is reachable), and mm1<label>_id... (-1 there).
+    """
+    rank_cols = ['%d%s' % (r + 1, label) for r in range(k)]
+    id_cols = ['%d%s_id' % (r + 1, label) for r in range(k)]
+    nodes = np.asarray(nodes, dtype = np.int64)
+    walk = np.asarray(walk, dtype = np.float64)
+    n, m = nodes.shape
+
+    # Row of each candidate node in near (last row: not in near, or no candidate).
+    keys = near['NN'].values.astype(np.int64)
+    order = np.argsort(keys, kind = 'stable')
+    pos = np.clip(np.searchsorted(keys[order], nodes), 0, max(len(keys) - 1, 0))
+    found = (keys[order][pos] == nodes) & (nodes >= 0) if len(keys) else np.zeros(nodes.shape, dtype = bool)
+    row = np.where(found, order[pos], len(keys))
+    T = np.vstack([near[rank_cols].values.astype(np.float64), np.full((1, k), np.inf)])
+    I = np.vstack([near[id_cols].values.astype(np.int64), np.full((1, k), -1, dtype = np.int64)])
+
+    times = (walk[:, :, None] + T[row]).reshape(n, m * k) # NaN (no walk or no drive) is no candidate
+    best, best_ids = merge_candidates(times, I[row].reshape(n, m * k), k, fail_value)
+
+    out = pd.DataFrame()
+    for r in range(k):
+        out['mm' + rank_cols[r]] = best[:, r]
+    for r in range(k):
+        out['mm' + id_cols[r]] = best_ids[:, r]
+    return out
+
+"""
+On-disk OD store
+
+The full OD matrix written straight to a float32 memory-mapped file, with the origin and
+destination node IDs as sidecar arrays. Replaces pd.DataFrame(OD, ...).to_csv('OD.csv'),
+which ran out of disk space and memory for 141,873 x 2,700. Slices for listD, listH, ...
+are read back by row chunks, so the whole matrix is never in memory at once.
+"""
+
+class ODStore(object):
+    """
+    OD matrix on disk. Rows are origins, columns destinations, cells travel times
+    (graph units, seconds for gTime) with the fail value where there is no path.
+    Rows are written in chunks of chunk_rows; done records which chunks are finished.
+    """
+
+    def __init__(self, folder, mode = 'r'):
+        self.folder = folder
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        self.fail_value = meta['fail_value']
+        self.chunk_rows = meta['chunk_rows']
+        self.origins = np.load(os.path.join(folder, 'origins.npy'))
+        self.dests = np.load(os.path.join(folder, 'dests.npy'))
+        self.times = np.memmap(os.path.join(folder, 'times.dat'), dtype = np.float32, mode = mode,
+                               shape = (len(self.origins), len(self.dests)))
+        self._cols = {d: j for j, d in enumerate(self.dests.tolist())}
+
+    @property
+    def shape(self):
+        return self.times.shape
+
+    @property
+    def n_chunks(self):
+        return int(np.ceil(len(self.origins) / float(self.chunk_rows)))
+
+    def chunk_slice(self, i):
+        return slice(i * self.chunk_rows, min((i + 1) * self.chunk_rows, len(self.origins)))
+
+    def done(self):
+        return np.load(os.path.join(self.folder, 'done.npy'))
+
+    def mark_done(self, i):
+        done = self.done()
+        done[i] = True
+        tmp = os.path.join(self.folder, 'done.tmp.npy')
+        np.save(tmp, done)
+        os.replace(tmp, os.path.join(self.folder, 'done.npy'))
+
+    def missing_chunks(self):
+        return list(np.flatnonzero(~self.done()))
+
+    def columns(self, dests):
+        # Column positions of destination node IDs, e.g. store.columns(listD).
+        return np.array([self._cols[d] for d in dests], dtype = np.int64)
+
+    def iter_chunks(self, dests = None, chunk_rows = None):
+        # Yields (row slice, block) with only the requested destination columns.
+        chunk_rows = chunk_rows or self.chunk_rows * 100
+        cols = None if dests is None else self.columns(dests)
+        for start in range(0, len(self.origins), chunk_rows):
+            rows = slice(start, min(start + chunk_rows, len(self.origins)))
+            block = np.asarray(self.times[rows])
+            yield rows, block if cols is None else block[:, cols]
+
+    def block(self, dests = None, rows = slice(None)):
+        if dests is None:
+            return np.asarray(self.times[rows])
+        return np.asarray(self.times[rows])[:, self.columns(dests)]
+
+    def frame(self, dests, minutes = True):
+        """
+        DataFrame of the OD times to some destinations, e.g. store.frame(listD) for ODD.
+        Indexed by origin node (NN). With minutes, times are converted to minutes and
+        missing paths become NaN, as with ODD[ODD < fail_value] / 60.
+        """
+        dests = list(dests)
+        out = np.concatenate([b for _, b in self.iter_chunks(dests)])
+        if minutes:
+            out = np.where(out < self.fail_value, out / 60, np.nan).astype(np.float32)
+        return pd.DataFrame(out, index = pd.Index(self.origins, name = 'NN'), columns = dests)
+
+
+def create_od_store(folder, origins, dests, fail_value = fail_value, chunk_rows = 100):
+    # Allocates the times file. Chunks are marked done as they are written.
+    origins = np.asarray(origins, dtype = np.int64)
+    dests = np.asarray(dests, dtype = np.int64)
+    if len(origins) == 0 or len(dests) == 0:
+        raise ValueError('an OD store needs at least one origin and one destination (got %d x %d)'
+                         % (len(origins), len(dests)))
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    np.save(os.path.join(folder, 'origins.npy'), origins)
+    np.save(os.path.join(folder, 'dests.npy'), dests)
+    n_chunks = int(np.ceil(len(origins) / float(chunk_rows)))
+    np.save(os.path.join(folder, 'done.npy'), np.zeros(n_chunks, dtype = bool))
+    times = np.memmap(os.path.join(folder, 'times.dat'), dtype = np.float32, mode = 'w+',
+                      shape = (len(origins), len(dests)))
+    del times
+    with open(os.path.join(folder, 'meta.json'), 'w') as f:
+        json.dump({'shape': [len(origins), len(dests)], 'dtype': 'float32', 'fail_value': fail_value,
+                   'chunk_rows': chunk_rows, 'units': 'graph weight (seconds for gTime)'}, f, indent = 1)
+    return ODStore(folder, mode = 'r+')
+
+
+def open_od_store(folder, mode = 'r'):
+    # Near-instant: only the ID sidecars are read, the times stay on disk until sliced.
+    return ODStore(folder, mode)
+
+
+def write_od_store(folder, OD, origins, dests, fail_value = fail_value, chunk_rows = 100):
+    # Store an OD matrix already in memory (e.g. from gn.calculate_OD).
+    store = create_od_store(folder, origins, dests, fail_value, chunk_rows)
+    for i in range(store.n_chunks):
+        rows = store.chunk_slice(i)
+        store.times[rows] = np.minimum(OD[rows], fail_value)
+    store.times.flush()
+    np.save(os.path.join(folder, 'done.npy'), np.ones(store.n_chunks, dtype = bool))
+    return open_od_store(folder)
+
+
+"""
+OD diff
+
+Comparing two full matrices with OD_df == flood_OD_df builds a third matrix in memory.
+diff_od_stores walks the two stores chunk by chunk and keeps only the cells that changed,
+plus running totals per origin and per destination.
+"""
+
+def diff_od_stores(base, scenario, out_path = None, tol = 1.0, weights = None, chunk_rows = None):
+    """
+    Changes between a baseline and a scenario ODStore with the same origins and destinations.
+
+    tol: smallest change (graph units, seconds for gTime) counted as a change
+    weights: per origin row (e.g. population of each unique origin node), for the catchments
+    out_path: CSV the changed cells are appended to chunk by chunk; without it they are returned
+
+    Returns (changes, by_origin, by_dest). changes has one row per changed cell: origin, dest,
+    base and scenario times and their delta, in minutes, NaN where there is no path (None when
+    written to out_path). by_origin counts per origin the newly unreachable and changed
+    destinations, with the mean and max delta of the ones still reachable. by_dest has the same
+    per destination, plus its catchment (origins, or weights, for which it is the nearest
+    destination) before and after, and lost_catchment: what it was nearest to before but no
+    longer is.
+    """
+    if not (np.array_equal(base.origins, scenario.origins) and np.array_equal(base.dests, scenario.dests)):
+        raise ValueError('OD stores have different origins or destinations')
+    fail = base.fail_value
+    n_o, n_d = base.shape
+    weights = np.ones(n_o) if weights is None else np.asarray(weights, dtype = np.float64)
+
+    o_lost = np.zeros(n_o, dtype = np.int64)
+    o_changed = np.zeros(n_o, dtype = np.int64)
+    o_sum = np.zeros(n_o)
+    o_n = np.zeros(n_o, dtype = np.int64)
+    o_max = np.full(n_o, np.nan)
+    d_lost = np.zeros(n_d, dtype = np.int64)
+    d_changed = np.zeros(n_d, dtype = np.int64)
+    d_sum = np.zeros(n_d)
+    d_n = np.zeros(n_d, dtype = np.int64)
+    catch_base = np.zeros(n_d)
+    catch_scen = np.zeros(n_d)
+    catch_lost = np.zeros(n_d)
+    changes = []
+    header = True
+
+    chunks = zip(base.iter_chunks(chunk_rows = chunk_rows), scenario.iter_chunks(chunk_rows = chunk_rows))
+    for (rows, b), (_, s) in chunks:
+        b_ok = b < fail
+        s_ok = s < fail
+        lost = b_ok & ~s_ok
+        both = b_ok & s_ok
+        delta = np.where(both, s.astype(np.float64) - b, 0)
+        changed = (b_ok != s_ok) | (both & (np.abs(delta) >= tol))
+
+        o_lost[rows] = lost.sum(axis = 1)
+        o_changed[rows] = changed.sum(axis = 1)
+        o_sum[rows] = np.where(changed, delta, 0).sum(axis = 1)
+        o_n[rows] = (changed & both).sum(axis = 1)
+        o_max[rows] = np.where(changed & both, delta, -np.inf).max(axis = 1) if n_d else np.nan
+        d_lost += lost.sum(axis = 0)
+        d_changed += changed.sum(axis = 0)
+        d_sum += np.where(changed, delta, 0).sum(axis = 0)
+        d_n += (changed & both).sum(axis = 0)
+
+        # Nearest destination of each origin before and after.
+        w = weights[rows]
+        if n_d:
+            nb = np.where(b_ok.any(axis = 1), b.argmin(axis = 1), -1)
+            ns = np.where(s_ok.any(axis = 1), s.argmin(axis = 1), -1)
+            catch_base += np.bincount(nb[nb >= 0], w[nb >= 0], minlength = n_d)
+            catch_scen += np.bincount(ns[ns >= 0], w[ns >= 0], minlength = n_d)
+            moved = (nb >= 0) & (nb != ns)
+            catch_lost += np.bincount(nb[moved], w[moved], minlength = n_d)
+
+        r, c = np.nonzero(changed)
+        if len(r) == 0:
+            continue
+        bt = b[r, c].astype(np.float64)
+        st = s[r, c].astype(np.float64)
+        cells = pd.DataFrame({'origin': base.origins[rows][r], 'dest': base.dests[c],
+                              'base': np.where(bt < fail, bt / 60, np.nan),
+                              'scenario': np.where(st < fail, st / 60, np.nan)})
+        cells['delta'] = cells['scenario'] - cells['base']
+        if out_path is None:
+            changes.append(cells)
+        else:
+            cells.to_csv(out_path, mode = 'w' if header else 'a', header = header, index = False)
+            header = False
+
+    by_origin = pd.DataFrame({'newly_unreachable': o_lost, 'changed': o_changed,
+                              'mean_delta': np.where(o_n > 0, o_sum / np.maximum(o_n, 1) / 60, np.nan),
+                              'max_delta': np.where(np.isfinite(o_max), o_max / 60, np.nan)},
+                             index = pd.Index(base.origins, name = 'NN'))
+    by_dest = pd.DataFrame({'newly_unreachable': d_lost, 'changed': d_changed,
+                            'mean_delta': np.where(d_n > 0, d_sum / np.maximum(d_n, 1) / 60, np.nan),
+                            'catchment_base': catch_base, 'catchment_scenario': catch_scen,
+                            'lost_catchment': catch_lost},
+                           index = pd.Index(base.dests, name = 'dest'))
+    by_dest = by_dest.sort_values('lost_catchment', ascending = False)
+    if out_path is not None:
+        if header: # nothing changed: still leave an empty table
+            pd.DataFrame(columns = ['origin', 'dest', 'base', 'scenario', 'delta']).to_csv(out_path, index = False)
+        return None, by_origin, by_dest
+    if changes:
+        changes = pd.concat(changes, ignore_index = True)
+    else:
+        changes = pd.DataFrame(columns = ['origin', 'dest', 'base', 'scenario', 'delta'])
+    return changes, by_origin, by_dest
+
+
+"""
+Parallel OD matrix
+
+Splits the origins into chunks and runs them across a process pool. Workers load the
+CSR graph memory-mapped from its folder (an.save_csr), so they share one read-only copy
+of the network instead of each unpickling gTime. Each chunk is written straight into an
+ODStore and marked done, so an interrupted run resumes with only the missing chunks.
+"""
+
+_od_worker = {}
+
+
+def _init_od_worker(csr_folder, store_folder, dest_idx, origin_idx, fail_value):
+    csr = an.load_csr(csr_folder)
+    _od_worker['matrix'] = csr.to_scipy()
+    _od_worker['store'] = open_od_store(store_folder, mode = 'r+')
+    _od_worker['dests'] = dest_idx
+    _od_worker['origins'] = origin_idx
+    _od_worker['fail_value'] = fail_value
+
+
+def _od_rows(matrix, origin_idx, dest_idx, fail_value):
+    # Shortest times from each origin index to each destination index, fail value where no path.
+    from scipy.sparse.csgraph import dijkstra
+    out = np.full((len(origin_idx), len(dest_idx)), fail_value, dtype = np.float32)
+    ok_o = origin_idx >= 0
+    ok_d = dest_idx >= 0
+    if ok_o.any() and ok_d.any():
+        dist = dijkstra(matrix, directed = True, indices = origin_idx[ok_o])[:, dest_idx[ok_d]]
+        dist[~np.isfinite(dist) | (dist >= fail_value)] = fail_value
+        out[np.ix_(ok_o, ok_d)] = dist
+    return out
+
+
+def _od_chunk(i):
+    # Chunks cover disjoint rows, so workers can write into the same memory-mapped file.
+    store = _od_worker['store']
+    rows = store.chunk_slice(i)
+    store.times[rows] = _od_rows(_od_worker['matrix'], _od_worker['origins'][rows],
+                                 _od_worker['dests'], _od_worker['fail_value'])
+    store.times.flush()
+    return i
+
+
+def calculate_OD_parallel(csr_folder, origins, dests, store_folder, fail_value = fail_value,
+                          chunk_size = 100, workers = None):
+    """
+    Drop-in for gn.calculate_OD(gTime, origins, dests, fail_value, weight = 'time') on many cores.
+
+    csr_folder: folder written by an.save_csr (the workers memory-map it)
+    origins, dests: lists of node IDs, e.g. list(inOsnap.NN.unique())
+    store_folder: ODStore the matrix is written to. Rerunning with the same origins and
+        dests only computes the chunks that are missing.
+    chunk_size: origins per chunk. Each chunk briefly holds chunk_size x (road nodes) times.
+    workers: number of processes (default: all cores). 1 runs in this process.
+
+    Returns the ODStore, rows in the order of origins and columns in the order of dests.
+    """
+    import multiprocessing
+
+    csr = an.load_csr(csr_folder)
+    origins = np.asarray(origins, dtype = np.int64)
+    dests = np.asarray(dests, dtype = np.int64)
+    origin_idx = csr.index_of(origins)
+    dest_idx = csr.index_of(dests)
+
+    # A store from a previous run is only reused if it was made for the same origins and dests.
+    if os.path.exists(os.path.join(store_folder, 'meta.json')):
+        store = open_od_store(store_folder)
+        if not (np.array_equal(store.origins, origins) and np.array_equal(store.dests, dests)):
+            raise ValueError('%s holds an OD matrix for different origins or dests. Use a new folder.' % store_folder)
+    else:
+        store = create_od_store(store_folder, origins, dests, fail_value, chunk_size)
+    n_chunks = store.n_chunks
+    jobs = store.missing_chunks()
+    if 0 < len(jobs) < n_chunks:
+        print('%d of %d chunks already done, resuming' % (n_chunks - len(jobs), n_chunks))
+
+    start = time.time()
+    done = n_chunks - len(jobs)
+    initargs = (csr_folder, store_folder, dest_idx, origin_idx, fail_value)
+    if workers == 1:
+        _init_od_worker(*initargs)
+        results = map(_od_chunk, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, initializer = _init_od_worker, initargs = initargs)
+        results = pool.imap_unordered(_od_chunk, jobs)
+    try:
+        for i in results:
+            store.mark_done(i)
+            done += 1
+            print('chunk %d done: %d of %d chunks, %.0f seconds' % (i, done, n_chunks, time.time() - start))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return open_od_store(store_folder)
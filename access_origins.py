@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Origin-side helpers for the accessibility scripts: the walk from each WorldPop
+point of origin to the road network.
+
+Shout out to Charles Fox for the original add_elevation() and generate_walktimes()
+functions these are built from.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+def walk_times(dist, delta_elevation, max_walkspeed = 6, min_speed = 0.1, dtype = np.float32):
+    """
+    Walking speed (km/h) and time (seconds) over whole arrays.
+
+    dist: walk distance in meters
+    delta_elevation: end elevation minus start elevation, in meters
+    Speed follows Tobler's hiking function, clamped to min_speed on steep inclines.
+    Zero distance gives a time of 0 (and flat-ground speed), even where an elevation is
+    missing; otherwise missing inputs give NaN.
+    """
+    # Tobler's hiking function: https://en.wikipedia.org/wiki/Tobler%27s_hiking_function
+    dist = np.asarray(dist, dtype = np.float64)
+    delta_elevation = np.asarray(delta_elevation, dtype = np.float64)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        incline_ratio = np.where(dist > 0, delta_elevation / dist, 0.0)
+        # Zero distance is no walk, whatever the elevations (which may be missing).
+        incline_ratio[np.isnan(dist) | ((dist > 0) & np.isnan(delta_elevation))] = np.nan
+        speed = np.maximum(max_walkspeed * np.exp(-3.5 * np.abs(incline_ratio + 0.05)), min_speed)
+        time = np.where(dist > 0, dist / 1000 * 3600 / speed, 0.0)
+    time[np.isnan(speed) | np.isnan(dist)] = np.nan
+    return speed.astype(dtype), time.astype(dtype)
+
+
+# Time is in seconds.
+def generate_walktimes(df, start = 'point_elev', end = 'node_elev', dist = 'NN_dist', max_walkspeed = 6,
+                       min_speed = 0.1, dtype = np.float32):
+    # Column-wise version of the iterrows() loop: adds walkspeed and walk_time to df.
+    # Rows with NN_dist == 0 (origin sits on its road node) get a walk_time of 0 instead of NaN.
+    delta_elevation = pd.to_numeric(df[end], errors = 'coerce').values - \
+        pd.to_numeric(df[start], errors = 'coerce').values
+    speed, time = walk_times(pd.to_numeric(df[dist], errors = 'coerce').values, delta_elevation,
+                             max_walkspeed, min_speed, dtype)
+    df['walkspeed'] = speed
+    df['walk_time'] = time
+    return df
+
+
+
+class OriginFanout(object):
+    """
+    Mapping from each origin to the unique road node it snapped to.
+
+    nodes: sorted unique NN values (the origins list for OD / nearest-k work)
+    index: int32, for each origin the position of its node in nodes (-1 if it did not snap)
+
+    Results computed once per unique node are spread back to all origins with a single
+    gather, instead of a 1 million row merge on NN per service.
+    """
+
+    def __init__(self, NN):
+        NN = pd.to_numeric(pd.Series(np.asarray(NN)), errors = 'coerce').values
+        ok = np.isfinite(NN) & (NN >= 0)
+        self.nodes, inverse = np.unique(NN[ok].astype(np.int64), return_inverse = True)
+        self.index = np.full(len(NN), -1, dtype = np.int32)
+        self.index[ok] = inverse.ravel()
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def n_nodes(self):
+        return len(self.nodes)
+
+    def expand(self, values, fill = np.nan):
+        # values has one row per unique node (in the order of nodes); returns one row per origin.
+        values = np.asarray(values)
+        out = values[np.maximum(self.index, 0)]
+        if (self.index < 0).any():
+            out = out.astype(np.result_type(out.dtype, np.float32)) if np.isnan(fill) else out.copy()
+            out[self.index < 0] = fill
+        return out
+
+    def lookup(self, table, columns, on = 'NN'):
+        """
+        Rows of a per-node table (e.g. Eall with NN, 1E, 2E, 3E) for every origin, as a DataFrame
+        with the given columns in origin order. Origins whose node is not in the table get NaN.
+        """
+        keys = np.asarray(table[on].values, dtype = np.int64)
+        order = np.argsort(keys, kind = 'stable')
+        pos = np.clip(np.searchsorted(keys[order], self.nodes), 0, max(len(keys) - 1, 0))
+        found = keys[order][pos] == self.nodes if len(keys) else np.zeros(len(self.nodes), dtype = bool)
+        row = np.where(found, order[pos], -1)
+        # Map each origin straight to its table row: one gather over the million origins.
+        origin_row = np.where(self.index >= 0, row[np.maximum(self.index, 0)], -1)
+        vals = table[columns].values.astype(np.float64)
+        out = np.full((len(self.index), len(columns)), np.nan)
+        hit = origin_row >= 0
+        out[hit] = vals[origin_row[hit]]
+        return pd.DataFrame(out, columns = columns)
+
+"""
+Snapping points to road nodes
+
+gn.pandana_snap rebuilds its lookup and reprojects point by point for each layer
+(about 20 minutes for the ~1 million WorldPop origins). SnapIndex is built once over the
+projected road node coordinates, saved next to the graph, and reused for the origins and
+every service layer. Reprojection and queries are vectorized and run in chunks.
+"""
+
+def project_points(x, y, source_crs = 'epsg:4326', target_crs = 'epsg:3920'):
+    # Bulk reprojection of coordinate arrays. No-op when the CRS are the same (or source_crs is None).
+    x = np.asarray(x, dtype = np.float64)
+    y = np.asarray(y, dtype = np.float64)
+    if source_crs is None or source_crs == target_crs:
+        return x, y
+    from pyproj import Transformer
+    transformer = Transformer.from_crs(source_crs, target_crs, always_xy = True)
+    px, py = transformer.transform(x, y)
+    return np.asarray(px), np.asarray(py)
+
+
+class SnapIndex(object):
+    """
+    KD-tree over the road nodes in a projected CRS (meters), e.g. 'epsg:3920' for Puerto Rico.
+    node_ids are the osmids the points snap to; px, py the projected node coordinates.
+    """
+
+    def __init__(self, node_ids, px, py, crs):
+        from scipy.spatial import cKDTree
+        self.node_ids = np.asarray(node_ids)
+        self.px = np.asarray(px, dtype = np.float64)
+        self.py = np.asarray(py, dtype = np.float64)
+        self.crs = crs
+        self.tree = cKDTree(np.column_stack([self.px, self.py]))
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def project(self, x, y, source_crs = 'epsg:4326'):
+        return project_points(x, y, source_crs, self.crs)
+
+    def query(self, x, y, source_crs = 'epsg:4326', k = 1, valid = None, chunk_size = 200000):
+        """
+        Nearest road node of each point.
+
+        k: number of candidate nodes to look at per point
+        valid: optional boolean array over the nodes (e.g. an.component_mask(gCSR)). Each point
+            takes its nearest valid candidate, so points next to a disconnected island snap to
+            the main network instead. Points with no valid candidate get -1 / NaN.
+
+        Returns NN (node index positions, -1 if none) and NN_dist (meters). Without valid and
+        with k > 1, returns all k candidates as n x k arrays, nearest first.
+        """
+        px, py = self.project(x, y, source_crs)
+        n = len(px)
+        k = min(k, len(self))
+        shape = (n,) if (k == 1 or valid is not None) else (n, k)
+        nn = np.full(shape, -1, dtype = np.int64)
+        dist = np.full(shape, np.nan)
+        for start in range(0, n, chunk_size):
+            rows = slice(start, min(start + chunk_size, n))
+            pts = np.column_stack([px[rows], py[rows]])
+            ok = np.isfinite(pts).all(axis = 1)
+            d, i = self.tree.query(pts[ok], k = k)
+            if valid is not None:
+                d = d.reshape(len(d), k)
+                i = i.reshape(len(i), k)
+                good = valid[i]
+                first = np.argmax(good, axis = 1)
+                has = good.any(axis = 1)
+                r = np.arange(len(i))
+                i = np.where(has, i[r, first], -1)
+                d = np.where(has, d[r, first], np.nan)
+            nn[rows][ok] = i
+            dist[rows][ok] = d
+        return nn, dist
+
+    def save(self, folder):
+        import json
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        np.save(os.path.join(folder, 'node_ids.npy'), self.node_ids)
+        np.save(os.path.join(folder, 'px.npy'), self.px)
+        np.save(os.path.join(folder, 'py.npy'), self.py)
+        with open(os.path.join(folder, 'meta.json'), 'w') as f:
+            json.dump({'crs': self.crs}, f)
+
+
+def build_snap_index(csr, source_crs = 'epsg:4326', target_crs = 'epsg:3920'):
+    # SnapIndex over the nodes of a CSRGraph (which keeps the node x, y from gTime).
+    px, py = project_points(csr.x, csr.y, source_crs, target_crs)
+    return SnapIndex(np.asarray(csr.node_ids), px, py, target_crs)
+
+
+def load_snap_index(folder):
+    # The tree itself is rebuilt from the saved coordinates, which takes well under a second.
+    import json
+    with open(os.path.join(folder, 'meta.json')) as f:
+        meta = json.load(f)
+    return SnapIndex(np.load(os.path.join(folder, 'node_ids.npy')), np.load(os.path.join(folder, 'px.npy')),
+                     np.load(os.path.join(folder, 'py.npy')), meta['crs'])
+
+
+def snap_points(index, df, x = None, y = None, source_crs = 'epsg:4326', k = 1, valid = None):
+    """
+    Like gn.pandana_snap(G, df, source_crs, target_crs, add_dist_to_node_col = True):
+    returns a copy of df with NN (node osmid) and NN_dist (meters) columns.
+    x, y: coordinate columns; by default the point geometry is used.
+    k, valid: see SnapIndex.query. Points with no valid node get NN = -1.
+    """
+    if x is None:
+        xs, ys = df.geometry.x.values, df.geometry.y.values
+    else:
+        xs, ys = pd.to_numeric(df[x]).values, pd.to_numeric(df[y]).values
+    if k > 1 and valid is None:
+        k = 1
+    nn, dist = index.query(xs, ys, source_crs, k = k, valid = valid)
+    out = df.copy()
+    out['NN'] = np.where(nn >= 0, index.node_ids[nn], -1)
+    out['NN_dist'] = dist
+    return out
+
+
+def snap_candidates(index, df, x = None, y = None, source_crs = 'epsg:4326', k = 4, valid = None):
+    """
+    The k nearest road nodes of each point instead of only the nearest, as the first-leg
+    candidates of multimodal routing (access_od.nearest_multimodal).
+
+    valid: as for snap_points; invalid nodes are skipped (2k nodes are looked at per point).
+    Returns NN (n x k node osmids, -1 where there are fewer candidates) and NN_dist
+    (n x k meters, NaN there), nearest first.
+    """
+    if x is None:
+        xs, ys = df.geometry.x.values, df.geometry.y.values
+    else:
+        xs, ys = pd.to_numeric(df[x]).values, pd.to_numeric(df[y]).values
+    m = min(2 * k if valid is not None else k, len(index))
+    nn, dist = index.query(xs, ys, source_crs, k = max(m, 2))
+    ok = nn >= 0
+    if valid is not None:
+        ok &= valid[np.maximum(nn, 0)]
+    # Valid candidates first, each group still nearest first.
+    order = np.argsort(~ok, axis = 1, kind = 'stable')[:, :k]
+    nn = np.take_along_axis(nn, order, axis = 1)
+    dist = np.take_along_axis(dist, order, axis = 1)
+    ok = np.take_along_axis(ok, order, axis = 1)
+    return np.where(ok, index.node_ids[np.maximum(nn, 0)], -1), np.where(ok, dist, np.nan)
+
+
+"""
+Snapping points to road edges
+
+Snapping to the nearest node overestimates the walk (and NN_dist) for points beside long
+rural edges. Inserting each origin into the graph as a new node is what errors_addnodes.py
+tried on the pandana Network; with a million origins it would also mean copying or mutating
+the graph. EdgeSnapIndex instead finds the nearest edge geometry, projects the point onto it
+and records the offsets to both end nodes. Routing then starts from that virtual node by
+adding the offsets to the end nodes' results (access_od.nearest_from_edges).
+"""
+
+class EdgeSnapIndex(object):
+    """
+    STRtree over the road edge geometries in a projected CRS (meters).
+    u, v: end node osmids of each edge; times: its travel time (seconds for gTime).
+    """
+
+    def __init__(self, u, v, geoms, times, crs):
+        import shapely
+        self.u = np.asarray(u, dtype = np.int64)
+        self.v = np.asarray(v, dtype = np.int64)
+        self.geoms = np.asarray(geoms)
+        self.times = np.asarray(times, dtype = np.float64)
+        self.lengths = shapely.length(self.geoms)
+        self.crs = crs
+        self.tree = shapely.STRtree(self.geoms)
+
+    def __len__(self):
+        return len(self.u)
+
+    def query(self, x, y, source_crs = 'epsg:4326'):
+        """
+        Nearest edge of each point, as a dict of arrays: edge (position in the index),
+        u, v, snap_x, snap_y (projected point on the edge, index CRS), NN_dist (meters to the edge),
+        along (meters from u), dist_u / dist_v (meters to each end) and time_u / time_v
+        (share of the edge's travel time to each end).
+        """
+        import shapely
+        px, py = project_points(x, y, source_crs, self.crs)
+        n = len(px)
+        edge = np.full(n, -1, dtype = np.int64)
+        ok = np.flatnonzero(np.isfinite(px) & np.isfinite(py))
+        pts = shapely.points(px[ok], py[ok])
+        hits = self.tree.query_nearest(pts, all_matches = False)
+        edge[ok[hits[0]]] = hits[1]
+
+        found = edge >= 0
+        e = edge[found]
+        out = {'edge': edge}
+        for name in ['u', 'v']:
+            out[name] = np.full(n, -1, dtype = np.int64)
+            out[name][found] = getattr(self, name)[e]
+        for name in ['snap_x', 'snap_y', 'NN_dist', 'along', 'dist_u', 'dist_v', 'time_u', 'time_v']:
+            out[name] = np.full(n, np.nan)
+
+        geoms = self.geoms[e]
+        pts = shapely.points(px[found], py[found])
+        along = shapely.line_locate_point(geoms, pts)
+        snapped = shapely.line_interpolate_point(geoms, along)
+        length = self.lengths[e]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            frac = np.where(length > 0, along / length, 0.0)
+        out['snap_x'][found] = shapely.get_x(snapped)
+        out['snap_y'][found] = shapely.get_y(snapped)
+        out['NN_dist'][found] = shapely.distance(pts, snapped)
+        out['along'][found] = along
+        out['dist_u'][found] = along
+        out['dist_v'][found] = length - along
+        out['time_u'][found] = frac * self.times[e]
+        out['time_v'][found] = (1 - frac) * self.times[e]
+        return out
+
+
+def build_edge_snap_index(edges, source_crs = 'epsg:4326', target_crs = 'epsg:3920', weight = 'time'):
+    # EdgeSnapIndex from an edge GeoDataFrame with u, v, geometry and time
+    # (e.g. gn.edge_gdf_from_graph(gTime), where edges without geometry get a straight line).
+    import geopandas as gpd
+    edges = gpd.GeoDataFrame(edges, geometry = 'geometry')
+    if edges.crs is None:
+        edges = edges.set_crs(source_crs)
+    edges = edges.to_crs(target_crs)
+    return EdgeSnapIndex(edges['u'].values, edges['v'].values, edges.geometry.values,
+                         pd.to_numeric(edges[weight]).values, target_crs)
+
+
+def snap_to_edges(index, df, x = None, y = None, source_crs = 'epsg:4326'):
+    """
+    Edge version of snap_points: returns a copy of df with edge_u, edge_v, snap_x, snap_y,
+    NN_dist (meters from the point to the edge), along, dist_u, dist_v, time_u and time_v.
+    """
+    if x is None:
+        xs, ys = df.geometry.x.values, df.geometry.y.values
+    else:
+        xs, ys = pd.to_numeric(df[x]).values, pd.to_numeric(df[y]).values
+    res = index.query(xs, ys, source_crs)
+    out = df.copy()
+    out['edge_u'] = res['u']
+    out['edge_v'] = res['v']
+    for name in ['snap_x', 'snap_y', 'NN_dist', 'along', 'dist_u', 'dist_v', 'time_u', 'time_v']:
+        out[name] = res[name]
+    return out
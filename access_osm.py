@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Offline road network from an OpenStreetMap .osm.pbf extract.
+
+ox.graph_from_polygon(bound, network_type = 'drive') downloads the network from the
+Overpass API (8-30 minutes for Puerto Rico) and builds a NetworkX graph. pbf_to_csr
+streams a local extract (e.g. puerto-rico-latest.osm.pbf from Geofabrik, or the
+morocco-latest.osm.pbf used with load_osm.OSM_to_network) once with pyosmium, keeps the
+drivable ways in the AOI, splits them at intersections and returns a CSRGraph with the
+length (meters), highway class and road geometry of every edge, ready for an.with_speeds.
+"""
+
+import numpy as np
+import access_network as an
+
+
+# Highway classes kept by default: the classes of the speed dictionaries and their links.
+drive_highways = ['motorway', 'motorway_link', 'trunk', 'trunk_link', 'primary', 'primary_link',
+                  'secondary', 'secondary_link', 'tertiary', 'tertiary_link', 'unclassified',
+                  'residential', 'living_street', 'road']
+
+_no_access = ('no', 'private')
+
+
+class _WayCollector(object):
+    # Flat arrays of the kept ways: node refs, their coordinates and per-way tags.
+
+    def __init__(self, highways):
+        self.highways = set(highways)
+        self.refs = []
+        self.lon = []
+        self.lat = []
+        self.way_len = []
+        self.highway = []
+        self.oneway = []
+
+    def way(self, w):
+        tags = w.tags
+        hw = tags.get('highway')
+        if hw not in self.highways or tags.get('area') == 'yes':
+            return
+        if tags.get('access') in _no_access or tags.get('motor_vehicle') in _no_access:
+            return
+        n = 0
+        for node in w.nodes:
+            if not node.location.valid():
+                continue
+            self.refs.append(node.ref)
+            self.lon.append(node.location.lon)
+            self.lat.append(node.location.lat)
+            n += 1
+        if n < 2:
+            del self.refs[len(self.refs) - n:], self.lon[len(self.lon) - n:], self.lat[len(self.lat) - n:]
+            return
+        ow = tags.get('oneway', '')
+        if ow in ('yes', 'true', '1') or tags.get('junction') == 'roundabout' or hw == 'motorway':
+            ow = 1
+        elif ow in ('-1', 'reverse'):
+            ow = -1
+        else:
+            ow = 0
+        self.way_len.append(n)
+        self.highway.append(hw)
+        self.oneway.append(ow)
+
+
+def read_pbf_ways(pbf_path, highways = drive_highways):
+    """
+    Stream the ways of a .osm.pbf with one of the highway classes, dropping areas and
+    access=no/private. Node locations are resolved by pyosmium (locations = True).
+
+    Returns (way_len, refs, lon, lat, highway, oneway): the node refs and coordinates of all
+    kept ways back to back, the number of nodes of each way, its class and its direction
+    (1 oneway, -1 oneway against the node order, 0 both ways).
+    """
+    import osmium
+    collector = _WayCollector(highways)
+
+    class Handler(osmium.SimpleHandler):
+        def way(self, w):
+            collector.way(w)
+
+    Handler().apply_file(pbf_path, locations = True)
+    return (np.asarray(collector.way_len, dtype = np.int64), np.asarray(collector.refs, dtype = np.int64),
+            np.asarray(collector.lon), np.asarray(collector.lat),
+            np.asarray(collector.highway, dtype = str), np.asarray(collector.oneway, dtype = np.int8))
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    # Great circle distance in meters.
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(a))
+
+
+def in_aoi(lon, lat, aoi):
+    # aoi: (minx, miny, maxx, maxy) bounding box, or a shapely polygon (e.g. bound from the AOI shapefile).
+    if aoi is None:
+        return np.ones(len(lon), dtype = bool)
+    if isinstance(aoi, (tuple, list)):
+        minx, miny, maxx, maxy = aoi
+        return (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+    import shapely
+    return shapely.contains_xy(aoi, lon, lat)
+
+
+def ways_to_csr(way_len, refs, lon, lat, highway, oneway, aoi = None):
+    """
+    Routable CSRGraph from the flat way arrays of read_pbf_ways.
+
+    Ways are split into edges at their end nodes and at every node shared with another way;
+    the nodes in between add to the edge length (haversine, meters) and are kept as the edge
+    geometry (the way coordinates are the vertex pool, see an.CSRGraph). Only edges with
+    both end nodes in the aoi are kept, like ox.graph_from_polygon. Oneway edges go one
+    direction, others both. Weights are the lengths; use an.with_speeds for travel times.
+    """
+    n = len(refs)
+    way = np.repeat(np.arange(len(way_len)), way_len)
+    first = np.zeros(len(way_len), dtype = np.int64)
+    np.cumsum(way_len[:-1], out = first[1:])
+    last = first + way_len - 1
+
+    # Graph nodes: way ends, and nodes seen more than once (shared by ways, or loops).
+    ids, inverse, counts = np.unique(refs, return_inverse = True, return_counts = True)
+    inverse = inverse.ravel()
+    split = counts[inverse] > 1
+    split[first] = True
+    split[last] = True
+
+    # Length of each piece between consecutive way nodes, summed between split nodes.
+    seg = np.zeros(n)
+    seg[1:] = haversine(lon[:-1], lat[:-1], lon[1:], lat[1:])
+    seg[first] = 0
+    cum = np.cumsum(seg)
+    pos = np.flatnonzero(split)
+    pairs = way[pos[:-1]] == way[pos[1:]] # consecutive split nodes on the same way
+    a = pos[:-1][pairs]
+    b = pos[1:][pairs]
+    length = cum[b] - cum[a]
+    ow = oneway[way[a]]
+
+    keep_node = in_aoi(lon, lat, aoi)
+    keep = keep_node[a] & keep_node[b]
+    a, b, length, ow, edge_way = a[keep], b[keep], length[keep], ow[keep], way[a[keep]]
+
+    # Both directions unless oneway; oneway = -1 runs against the node order.
+    fwd = ow >= 0
+    bwd = ow <= 0
+    us = np.concatenate([a[fwd], b[bwd]])
+    vs = np.concatenate([b[fwd], a[bwd]])
+    lengths = np.concatenate([length[fwd], length[bwd]]).astype(np.float32)
+    ew = np.concatenate([edge_way[fwd], edge_way[bwd]])
+    geom_start = np.concatenate([a[fwd], b[bwd]])
+    geom_end = np.concatenate([b[fwd], a[bwd]])
+
+    # Compact node index over the nodes that are on a kept edge.
+    node_pos = np.unique(inverse[np.concatenate([us, vs])])
+    index = np.full(len(ids), -1, dtype = np.int64)
+    index[node_pos] = np.arange(len(node_pos))
+    rep = np.zeros(len(ids), dtype = np.int64)
+    rep[inverse] = np.arange(n) # any occurrence, for the coordinates
+    classes, codes = np.unique(highway, return_inverse = True)
+
+    return an.edges_to_csr(index[inverse[us]].astype(np.int32), index[inverse[vs]].astype(np.int32), lengths,
+                           ids[node_pos], lon[rep[node_pos]], lat[rep[node_pos]], lengths,
+                           codes.ravel()[ew].astype(np.int16), classes, geom_start, geom_end, lon, lat)
+
+
+def pbf_to_csr(pbf_path, aoi = None, highways = drive_highways):
+    """
+    Drivable road network of a .osm.pbf extract as a CSRGraph, offline.
+
+    aoi: shapely polygon (e.g. the Puerto Rico bound or the Tinghir AOI from their shapefiles)
+        or a (minx, miny, maxx, maxy) box in WGS84. None keeps the whole extract.
+    highways: highway classes to keep (drive_highways by default)
+    """
+    return ways_to_csr(*read_pbf_ways(pbf_path, highways), aoi = aoi)
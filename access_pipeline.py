@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline plumbing for the accessibility scripts.
+
+Checkpoints: the tables passed between stages (inOsnap, O_elev, zwalk, Et, Etz...) were
+written to CSV, which takes minutes for the ~1 million origins, loses the dtypes, turns
+the index into 'Unnamed: 0' and geometry into text. write_checkpoint stores them as
+Parquet instead: typed columns, the index kept as is, shapely geometry as WKB, and the
+CRS of a GeoDataFrame in the file metadata. read_checkpoint reads only the columns asked for.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import inspect
+import sysconfig
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import pandas as pd
+import access_network as an
+import access_od as ao
+import access_origins as aor
+import access_raster as ar
+import access_aggregate as aa
+
+
+_geo_key = b'access_geometry'
+
+
+def _is_geometry(col):
+    # Column of shapely geometries (GeoSeries, or object column of geometries).
+    if getattr(col, 'dtype', None) is not None and str(col.dtype) == 'geometry':
+        return True
+    if col.dtype != object or len(col) == 0:
+        return False
+    import shapely
+    first = col.first_valid_index()
+    return first is not None and isinstance(col.loc[first], shapely.Geometry)
+
+
+def write_checkpoint(df, path):
+    """
+    Save a DataFrame or GeoDataFrame as Parquet.
+
+    Geometry columns are stored as WKB and listed, with the CRS, in the file metadata,
+    so read_checkpoint returns them as shapely geometries (a GeoDataFrame when geopandas
+    is installed and there was a CRS).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import shapely
+    geo = {'columns': [], 'crs': None, 'active': None}
+    out = pd.DataFrame(df, copy = False)
+    for c in list(out.columns):
+        if _is_geometry(out[c]):
+            geo['columns'].append(c)
+            out[c] = shapely.to_wkb(np.asarray(out[c], dtype = object))
+    crs = getattr(df, 'crs', None)
+    if crs is not None and geo['columns']:
+        geo['crs'] = crs.to_string() if hasattr(crs, 'to_string') else str(crs)
+        geo['active'] = df.geometry.name
+    table = pa.Table.from_pandas(out)
+    meta = dict(table.schema.metadata or {})
+    meta[_geo_key] = json.dumps(geo).encode('utf-8')
+    pq.write_table(table.replace_schema_metadata(meta), path)
+
+
+def read_checkpoint(path, columns = None):
+    # Read a checkpoint, or only some of its columns (the index always comes back as it was saved).
+    import pyarrow.parquet as pq
+    table = pq.read_pandas(path, columns = columns)
+    meta = table.schema.metadata or {}
+    geo = json.loads(meta[_geo_key].decode('utf-8')) if _geo_key in meta else {'columns': []}
+    df = table.to_pandas()
+    present = [c for c in geo['columns'] if c in df.columns]
+    if present:
+        import shapely
+        for c in present:
+            df[c] = shapely.from_wkb(df[c].values)
+        if geo.get('crs') and geo.get('active') in present:
+            try:
+                import geopandas as gpd
+            except ImportError:
+                return df
+            df = gpd.GeoDataFrame(df, geometry = geo['active'], crs = geo['crs'])
+    return df
+
+
+def checkpoint_columns(path):
+    # Column names of a checkpoint without reading it, to choose what to load.
+    import pyarrow.parquet as pq
+    return pq.read_schema(path).names
+
+
+"""
+Stage runner
+
+The script is run as #%% cells with "If starting new session, load from disk" blocks,
+and which cells to rerun is left to whoever runs it. A Pipeline declares each stage
+(function, upstream stages, parameters, input files) and keys its output by a hash of the
+function source, the project modules it calls, the parameters, the input files and the keys
+of its upstream stages.
+Stages whose key has not changed are loaded from disk instead of run, independent stages
+run in parallel processes, and every run records how long each stage took.
+"""
+
+class Stage(object):
+
+    def __init__(self, name, func, inputs = (), params = None, files = ()):
+        self.name = name
+        self.func = func
+        # Upstream stages by argument name; a list passes each under its own name.
+        self.inputs = dict(inputs) if isinstance(inputs, dict) else {i: i for i in inputs}
+        self.params = dict(params or {})
+        self.files = list(files)
+
+
+def _code_names(code):
+    # Global names used by a code object and the functions, lambdas and comprehensions inside it.
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+
+def _is_local(module):
+    # Modules of this project (e.g. access_od), as opposed to the standard library and installed packages.
+    f = getattr(module, '__file__', None)
+    if f is None:
+        return False
+    f = os.path.abspath(f)
+    installed = [sysconfig.get_paths()[k] for k in ('stdlib', 'platstdlib', 'purelib', 'platlib')]
+    return not any(f.startswith(os.path.abspath(p) + os.sep) for p in installed) and \
+        'site-packages' not in f and 'dist-packages' not in f
+
+
+def _module_stamps(func):
+    """
+    What the stage function's code depends on besides its own source: the full source of every
+    project module it calls (ao.nearest_k, aor.snap_points...) and of the project modules those
+    import, and the version of the installed packages any of them use (numpy, pandas...).
+    """
+    if not hasattr(func, '__code__'):
+        return {}
+    names = _code_names(func.__code__)
+    glb = func.__globals__
+    todo = [glb[n] for n in sorted(names) if inspect.ismodule(glb.get(n))]
+    local = {}
+    versions = {}
+    while todo:
+        mod = todo.pop()
+        if not _is_local(mod):
+            base = sys.modules.get(mod.__name__.split('.')[0], mod)
+            if getattr(base, '__version__', None) is not None:
+                versions[base.__name__] = str(base.__version__)
+            continue
+        if mod.__name__ in local:
+            continue
+        with open(mod.__file__, 'rb') as f:
+            local[mod.__name__] = hashlib.sha1(f.read()).hexdigest()
+        todo.extend(v for v in vars(mod).values() if inspect.ismodule(v))
+    return {'modules': local, 'versions': versions}
+
+
+def _file_stamp(path):
+    # Input files are keyed by size and modification time rather than hashed in full
+    # (the WorldPop origins are hundreds of MB). Folders are walked.
+    if os.path.isdir(path):
+        out = []
+        for root, folders, files in os.walk(path):
+            for f in sorted(files):
+                out.append(_file_stamp(os.path.join(root, f)))
+        return out
+    if not os.path.exists(path):
+        return [path, None]
+    st = os.stat(path)
+    return [path, st.st_size, int(st.st_mtime)]
+
+
+def _save_output(value, path):
+    # DataFrames as Parquet checkpoints, road graphs as network artifacts, anything else pickled.
+    if isinstance(value, pd.DataFrame):
+        write_checkpoint(value, path + '.parquet')
+        return path + '.parquet'
+    if isinstance(value, an.CSRGraph) and value.edge_ids is None: # reversed graphs are not artifacts
+        an.save_network(path + '.network', value)
+        return path + '.network'
+    with open(path + '.pickle', 'wb') as f:
+        pickle.dump(value, f, protocol = pickle.HIGHEST_PROTOCOL)
+    return path + '.pickle'
+
+
+def _load_output(path):
+    if path.endswith('.parquet'):
+        return read_checkpoint(path)
+    if path.endswith('.network'):
+        return an.load_network(path, verify = True).csr
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _run_stage(func, params, input_paths, out_path):
+    # Runs in a worker process: inputs come from disk, the output goes back to disk.
+    start = time.time()
+    kwargs = {name: _load_output(p) for name, p in input_paths.items()}
+    kwargs.update(params)
+    value = func(**kwargs)
+    path = _save_output(value, out_path)
+    return path, time.time() - start
+
+
+class Pipeline(object):
+    """
+    Stages and their cached outputs in folder (one file per stage and key, plus
+    manifest.json with the current key, output file and last timing of each stage).
+    Outputs are stored by type: DataFrames as Parquet checkpoints, CSRGraphs as network
+    artifacts (an.save_network; checksums verified on load), anything else pickled.
+
+    Stage functions take their upstream outputs and parameters as keyword arguments
+    (named after the upstream stages and the parameter names) and return one value.
+    They must be module-level functions so worker processes can run them.
+
+    A stage's key covers its function source, the source of the project modules it calls
+    (and of the ones those import), the versions of the packages they use, its parameters,
+    its declared input files and its upstream keys. It does not cover global constants or
+    other functions of the script the stage function uses, nor files it reads without
+    declaring them: pass those as parameters or files, or rerun with force.
+    """
+
+    def __init__(self, folder, workers = None):
+        self.folder = folder
+        self.workers = workers or os.cpu_count()
+        self.stages = {}
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self._manifest_path = os.path.join(folder, 'manifest.json')
+        self.manifest = {}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def stage(self, name, func, inputs = (), params = None, files = ()):
+        """
+        Declare a stage. inputs are names of stages declared before it, passed to func under
+        the same names, or a dict of argument name -> stage (e.g. {'points': 'load_D'}).
+        """
+        stage = Stage(name, func, inputs, params, files)
+        for i in stage.inputs.values():
+            if i not in self.stages:
+                raise ValueError('stage %s: unknown input stage %s' % (name, i))
+        self.stages[name] = stage
+        return name
+
+    def key(self, name, _keys = None):
+        # Content hash of a stage: function source, parameters, input files, upstream keys.
+        _keys = {} if _keys is None else _keys
+        if name in _keys:
+            return _keys[name]
+        s = self.stages[name]
+        try:
+            source = inspect.getsource(s.func)
+        except (OSError, TypeError):
+            source = s.func.__module__ + '.' + s.func.__name__
+        text = json.dumps({'source': source, 'code': _module_stamps(s.func), 'params': s.params,
+                           'files': [_file_stamp(f) for f in s.files],
+                           'inputs': [[a, i, self.key(i, _keys)] for a, i in sorted(s.inputs.items())]},
+                          sort_keys = True, default = str)
+        _keys[name] = hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+        return _keys[name]
+
+    def up_to_date(self, name, _keys = None):
+        entry = self.manifest.get(name)
+        return entry is not None and entry['key'] == self.key(name, _keys) and os.path.exists(entry['output'])
+
+    def load(self, name):
+        # Output of a stage from its last run.
+        return _load_output(self.manifest[name]['output'])
+
+    def _needed(self, targets):
+        needed = []
+        todo = list(targets)
+        while todo:
+            n = todo.pop()
+            if n not in needed:
+                needed.append(n)
+                todo.extend(self.stages[n].inputs.values())
+        return [n for n in self.stages if n in needed] # declaration order
+
+    def run(self, targets = None, force = ()):
+        """
+        Bring targets (default: every stage) and what they depend on up to date.
+        force: stages to rerun even if their key has not changed.
+
+        Returns a DataFrame with one row per stage: key, status (ran / cached) and seconds.
+        """
+        names = self._needed(targets or list(self.stages))
+        keys = {}
+        status = {}
+        seconds = {}
+        for n in names:
+            self.key(n, keys)
+            if n not in force and self.up_to_date(n, keys):
+                status[n] = 'cached'
+                seconds[n] = 0.0
+        pending = [n for n in names if n not in status]
+
+        def submit(pool, n):
+            s = self.stages[n]
+            inputs = {a: self.manifest[i]['output'] for a, i in s.inputs.items()}
+            out = os.path.join(self.folder, '%s-%s' % (n, keys[n]))
+            print('running %s' % n)
+            if pool is None:
+                return _run_stage(s.func, s.params, inputs, out)
+            return pool.submit(_run_stage, s.func, s.params, inputs, out)
+
+        def finish(n, result):
+            path, secs = result
+            status[n] = 'ran'
+            seconds[n] = secs
+            old = self.manifest.get(n)
+            if old is not None and old['output'] != path and os.path.exists(old['output']):
+                if os.path.isdir(old['output']):
+                    shutil.rmtree(old['output'])
+                else:
+                    os.remove(old['output'])
+            self.manifest[n] = {'key': keys[n], 'output': path, 'seconds': secs,
+                                'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+            with open(self._manifest_path, 'w') as f:
+                json.dump(self.manifest, f, indent = 1)
+            print('%s done in %.1f seconds' % (n, secs))
+
+        def ready(n):
+            return all(status.get(i) in ('ran', 'cached') for i in self.stages[n].inputs.values())
+
+        if self.workers <= 1:
+            for n in pending:
+                finish(n, submit(None, n))
+        else:
+            with ProcessPoolExecutor(self.workers) as pool:
+                running = {}
+                while pending or running:
+                    for n in [n for n in pending if ready(n)]:
+                        pending.remove(n)
+                        running[submit(pool, n)] = n
+                    done, _ = wait(list(running), return_when = FIRST_COMPLETED)
+                    for fut in done:
+                        finish(running.pop(fut), fut.result())
+
+        return pd.DataFrame({'stage': names, 'key': [keys[n] for n in names],
+                             'status': [status[n] for n in names], 'seconds': [seconds[n] for n in names]})
+
+
+"""
+Streaming origins
+
+The origin steps load wpop3wgs84.shp (~1 million rows) whole and keep several full copies
+of it (inO, inOsnap, inOsnap2, O_elev, zvalues, zwalk, zwalkE). stream_origins reads the
+origins in fixed-size batches and takes each batch through snap, elevation, walk time,
+the per-node nearest-k lookup and mm1/mm2/mm3, adds it to a MunicipalAccumulator and drops
+it, so peak memory depends on the batch size and not on the number of origins. Everything
+per node (snap index, node elevation, nearest-k tables) is small and stays in memory.
+"""
+
+def iter_origins(path, batch_size = 100000, columns = None):
+    """
+    Consecutive batches of a point layer as DataFrames with x, y columns (no geometry).
+
+    path: a Parquet checkpoint (read by row groups with pyarrow) or any file geopandas reads
+        (e.g. wpop3wgs84.shp, read batch_size rows at a time)
+    columns: attribute columns to keep (e.g. ['wpop', 'xmid', 'wid']), default all
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        import shapely
+        pf = pq.ParquetFile(path)
+        meta = pf.schema_arrow.metadata or {}
+        geo = json.loads(meta[_geo_key].decode('utf-8')) if _geo_key in meta else {'columns': []}
+        active = geo.get('active') or (geo['columns'][0] if geo['columns'] else None)
+        read = None if columns is None else list(columns) + ([active] if active else [])
+        for batch in pf.iter_batches(batch_size = batch_size, columns = read):
+            df = batch.to_pandas()
+            if active is not None:
+                pts = shapely.from_wkb(df.pop(active).values)
+                df['x'] = shapely.get_x(pts)
+                df['y'] = shapely.get_y(pts)
+            yield df
+        return
+    import geopandas as gpd
+    start = 0
+    while True:
+        gdf = gpd.read_file(path, rows = slice(start, start + batch_size))
+        if len(gdf) == 0:
+            return
+        df = pd.DataFrame(gdf.drop(columns = 'geometry') if columns is None else gdf[list(columns)])
+        df['x'] = gdf.geometry.x.values
+        df['y'] = gdf.geometry.y.values
+        yield df
+        start += len(gdf)
+        if len(gdf) < batch_size:
+            return
+
+
+def stream_origins(origins, snap_index, node_elev, near, srtm_pth, accumulator = None, valid = None, k = 8,
+                   batch_size = 100000, columns = ('wpop', 'xmid', 'wid'), group = 'xmid', weight = 'wpop',
+                   out_path = None, cache = None, access_nodes = 1):
+    """
+    Multimodal times of every origin, batch by batch, into municipal accumulators.
+
+    origins: origin layer path for iter_origins (e.g. wpop3wgs84.shp), or an iterable of
+        DataFrames with x, y and the columns
+    snap_index: aor.SnapIndex of the road nodes; valid, k as for aor.snap_points
+    node_elev: per-node table with NN and node_elev
+    near: {label: per-node table with NN and 1<label>, 2<label>... in minutes}, e.g. Dall..Eall
+    accumulator: aa.MunicipalAccumulator to add to. By default one over mm1<label>.. for every
+        label and rank in near, with its default thresholds and percentiles.
+    out_path: optionally also write the per-origin walk and multimodal times to this Parquet
+        file, one row group per batch
+    access_nodes: with 1, walk to the nearest road node and add its drive times (mm1E =
+        walk_time + 1E). With more, each origin may walk to any of its access_nodes nearest
+        nodes and takes the best total walk + drive time (ao.nearest_multimodal); near must
+        then have the 1<label>_id... columns, and walk_time and NN are for the nearest node.
+
+    Returns the accumulator (accumulator.frame(group) is the municipal table).
+    """
+    ranks = {label: [c for c in table.columns if c != 'NN' and not c.endswith('_id')]
+             for label, table in near.items()}
+    if accumulator is None:
+        accumulator = aa.MunicipalAccumulator(['mm' + c for cols in ranks.values() for c in cols])
+    batches = iter_origins(origins, batch_size, columns) if isinstance(origins, str) else origins
+    writer = None
+    n = 0
+    for batch in batches:
+        if access_nodes > 1:
+            nodes, dist = aor.snap_candidates(snap_index, batch, 'x', 'y', k = access_nodes, valid = valid)
+            snap = batch.copy()
+            snap['NN'] = nodes[:, 0]
+            snap['NN_dist'] = dist[:, 0]
+            ar.add_elevation(snap, 'x', 'y', srtm_pth, cache)
+            node_z = aor.OriginFanout(nodes.ravel()).lookup(node_elev, ['node_elev'])['node_elev'].values
+            walk = aor.walk_times(dist, node_z.reshape(nodes.shape) - snap['point_elev'].values[:, None])[1] / 60
+            times = {'walk_time': walk[:, 0]}
+            for label, cols in ranks.items():
+                mm = ao.nearest_multimodal(near[label], nodes, walk, k = len(cols), label = label)
+                for c in cols:
+                    times['mm' + c] = mm['mm' + c].where(mm['mm' + c] < ao.fail_value).values
+        else:
+            snap = aor.snap_points(snap_index, batch, 'x', 'y', k = k, valid = valid)
+            ar.add_elevation(snap, 'x', 'y', srtm_pth, cache)
+            fanout = aor.OriginFanout(snap['NN'])
+            snap['node_elev'] = fanout.lookup(node_elev, ['node_elev'])['node_elev'].values
+            aor.generate_walktimes(snap)
+            walk = snap['walk_time'].values / 60 # minutes
+            times = {'walk_time': walk}
+            for label, cols in ranks.items():
+                drive = fanout.lookup(near[label], cols).values
+                for r, c in enumerate(cols):
+                    times['mm' + c] = walk + drive[:, r]
+        accumulator.add(snap[group].values, snap[weight].values, times)
+        if out_path is not None:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            out = snap[list(columns) + ['NN']].reset_index(drop = True)
+            for c, v in times.items():
+                out[c] = v
+            table = pa.Table.from_pandas(out, preserve_index = False)
+            if writer is None:
+                writer = pq.ParquetWriter(out_path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        n += len(batch)
+        print('%d origins done' % n)
+    if writer is not None:
+        writer.close()
+    return accumulator
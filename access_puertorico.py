@@ -15,6 +15,8 @@ from pandana.loaders import osm
 import mpl_toolkits
 from mpl_toolkits.basemap import pyproj
 import networkx as nx
+import access_network as an
+import access_od as ao
 
 #%% 
 # configure search at a max distance of 1 km for up to the 10 nearest points-of-interest
@@ -51,6 +53,13 @@ start_time = time.time()
 network = pandana.network.Network.from_hdf5('prallislands_network_allnodes.h5')
 method = 'loaded from HDF5'
 
+# Routing arrays of the same network, converted once and then memory-mapped (under a second).
+if os.path.isdir('prallislands_network_allnodes_csr'):
+    csr = an.load_csr('prallislands_network_allnodes_csr')
+else:
+    csr = an.hdf5_to_csr('prallislands_network_allnodes.h5', impedance = 'distance')
+    an.save_network('prallislands_network_allnodes_csr', csr, meta = {'source': 'prallislands_network_allnodes.h5'})
+
 print('Network with {:,} nodes {} in {:,.2f} secs'.format(len(network.node_ids), method, time.time()-start_time))
 
 
@@ -61,17 +70,16 @@ Calculate accessibility to any amenity we retrieved
 
 """
 
-# precomputes the range queries (the reachable nodes within this maximum distance)
-# so, as long as you use a smaller distance, cached results will be used
-network.precompute(distance + 1)
-
-#%%
-# initialize a category for all amenities with the locations specified by the lon and lat columns
-network.set_pois(category='all', maxdist=distance, maxitems=num_pois, x_col=pois['long'], y_col=pois['lat'])
+# No network.precompute(distance + 1): it stores every node's range query, which grows with
+# the square of the distance. No precomputed index replaces it: every ao.nearest_pois call runs
+# a fresh search outward from all POIs at once, stopping at distance or once each node has
+# num_pois of them. On a 302,500-node test grid (50 POIs, num_pois = 5) that took 1.0 s at 1km
+# and 15.7 s at 40km; not timed on this network.
 
 #%%
 # searches for the n nearest amenities (of all types) to each node in the network
-dialysis_access = network.nearest_pois(distance=distance, category='all', num_pois=num_pois)
+# Same output as network.set_pois + network.nearest_pois: node id index, columns 1..num_pois.
+dialysis_access = ao.nearest_pois(csr, pois['long'], pois['lat'], distance, num_pois = num_pois)
 
 #%%
 network2_gdf = network.nodes_df
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Raster sampling for the accessibility scripts (SRTM elevation, flood depth).
+
+Points are grouped by tile with floor arithmetic, each tile is read into memory once,
+coordinates become pixel indices through the raster's affine transform, and values are
+gathered with array indexing. No per-row apply(), DataFrame copies or iterrows().
+
+The SRTM tiles are listed once in a tile index (tile_index.json next to the data) and
+decoded tiles are kept in an LRU cache, so the node, origin and scenario lookups of one
+session reuse them instead of re-reading from disk.
+"""
+
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+def pixel_index(transform, x, y):
+    # Row and column of each coordinate, through the inverse of the raster's affine transform.
+    inv = ~transform
+    col = np.floor(inv.a * x + inv.b * y + inv.c).astype(np.int64)
+    row = np.floor(inv.d * x + inv.e * y + inv.f).astype(np.int64)
+    return row, col
+
+
+def sample_array(arr, transform, x, y, nodata = None):
+    """
+    Values of a 2D raster array at coordinates x, y (same CRS as the raster).
+    Points outside the raster, and nodata cells, get NaN.
+    """
+    x = np.asarray(x, dtype = np.float64)
+    y = np.asarray(y, dtype = np.float64)
+    out = np.full(len(x), np.nan)
+    row, col = pixel_index(transform, x, y)
+    inside = (row >= 0) & (row < arr.shape[0]) & (col >= 0) & (col < arr.shape[1])
+    vals = arr[row[inside], col[inside]].astype(np.float64)
+    if nodata is not None:
+        vals[vals == nodata] = np.nan
+    out[inside] = vals
+    return out
+
+
+def sample_points(x, y, raster_path, band = 1):
+    # Sample one band of a raster file at many points in one read.
+    import rasterio as rt
+    with rt.open(raster_path, 'r') as dataset:
+        arr = dataset.read(band)
+        return sample_array(arr, dataset.transform, x, y, dataset.nodata)
+
+
+def tile_codes(x, y):
+    # SRTM 1 degree tile name of each point, e.g. (-66.6, 18.4) -> 'N18W067'.
+    # Names are only built once per distinct tile, then gathered back to the points.
+    lat = np.floor(np.asarray(y, dtype = np.float64)).astype(np.int64)
+    lon = np.floor(np.asarray(x, dtype = np.float64)).astype(np.int64)
+    keys, inverse = np.unique(lat * 1000 + lon, return_inverse = True)
+    names = []
+    for key in keys:
+        la, lo = divmod(int(key), 1000)
+        if lo >= 500: # divmod floors, so undo the borrow for negative longitudes
+            la, lo = la + 1, lo - 1000
+        names.append('%s%02d%s%03d' % ('N' if la >= 0 else 'S', abs(la), 'E' if lo >= 0 else 'W', abs(lo)))
+    return np.array(names)[inverse.ravel()]
+
+
+def build_tile_index(srtm_pth):
+    """
+    List every .hgt under srtm_pth/high_res, plus the low-res srtm_pth/clipped/W100N40.GIF,
+    with its bounds, shape, dtype and nodata, and save it to srtm_pth/tile_index.json.
+    Paths are stored relative to srtm_pth with forward slashes, so the index works on any OS.
+    """
+    import rasterio as rt
+    rasters = {}
+    for root, folder, files in os.walk(os.path.join(srtm_pth, 'high_res')):
+        for f in files:
+            if f[-3:] == 'hgt':
+                rasters[f[:-4]] = os.path.join(root, f)
+    low_res = os.path.join(srtm_pth, 'clipped', 'W100N40.GIF')
+    if os.path.exists(low_res):
+        rasters['low_res'] = low_res
+
+    index = {}
+    for code, path in rasters.items():
+        with rt.open(path, 'r') as dataset:
+            index[code] = {'path': os.path.relpath(path, srtm_pth).replace(os.sep, '/'),
+                           'bounds': list(dataset.bounds),
+                           'shape': [dataset.height, dataset.width],
+                           'dtype': dataset.dtypes[0],
+                           'nodata': dataset.nodata}
+    with open(os.path.join(srtm_pth, 'tile_index.json'), 'w') as f:
+        json.dump(index, f, indent = 1)
+    return index
+
+
+def load_tile_index(srtm_pth, rebuild = False):
+    # The saved tile index, built on first use.
+    f = os.path.join(srtm_pth, 'tile_index.json')
+    if rebuild or not os.path.exists(f):
+        return build_tile_index(srtm_pth)
+    with open(f) as fh:
+        return json.load(fh)
+
+
+class TileCache(object):
+    """
+    Decoded raster tiles (array, transform, nodata) keyed by file path, least recently used
+    first out once the arrays take more than max_bytes. A 1 arc-second SRTM tile is ~26 MB.
+    """
+
+    def __init__(self, max_bytes = 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._tiles = OrderedDict()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, path):
+        if path in self._tiles:
+            self._tiles.move_to_end(path)
+            return self._tiles[path]
+        import rasterio as rt
+        with rt.open(path, 'r') as dataset:
+            tile = (dataset.read(1), dataset.transform, dataset.nodata)
+        self._tiles[path] = tile
+        self.nbytes += tile[0].nbytes
+        while self.nbytes > self.max_bytes and len(self._tiles) > 1:
+            old_path, old = self._tiles.popitem(last = False)
+            self.nbytes -= old[0].nbytes
+        return tile
+
+    def clear(self):
+        self._tiles.clear()
+        self.nbytes = 0
+
+
+tile_cache = TileCache() # Shared by every lookup in the session unless a cache is passed in.
+
+
+def sample_elevation(x, y, srtm_pth, cache = None):
+    """
+    Elevation (meters) at each x, y (WGS84) from the SRTM tiles in srtm_pth/high_res.
+
+    Points on voids (negative values) or without a high-res tile fall back to the
+    low-res srtm_pth/clipped/W100N40.GIF layer in the same pass. NaN where neither has data.
+    Tiles come from the tile index and through the tile cache.
+    """
+    cache = tile_cache if cache is None else cache
+    x = np.asarray(x, dtype = np.float64)
+    y = np.asarray(y, dtype = np.float64)
+    elev = np.full(len(x), np.nan)
+    codes = tile_codes(x, y)
+    index = load_tile_index(srtm_pth)
+
+    # Match on High Precision Elevation
+    for code in np.unique(codes):
+        if code not in index:
+            continue
+        sel = np.flatnonzero(codes == code)
+        arr, transform, nodata = cache.get(os.path.join(srtm_pth, index[code]['path']))
+        elev[sel] = sample_array(arr, transform, x[sel], y[sel], nodata)
+
+    missing = np.flatnonzero(~(elev >= 0))
+    print('missing: %s' % len(missing))
+
+    if len(missing) > 0 and 'low_res' in index:
+        arr, transform, nodata = cache.get(os.path.join(srtm_pth, index['low_res']['path']))
+        elev[missing] = sample_array(arr, transform, x[missing], y[missing], nodata)
+    return elev
+
+
+def add_elevation(df, x, y, srtm_pth, cache = None):
+    # Adds point_elev to df from its x and y columns. Same output as the old add_elevation.
+    df['point_elev'] = sample_elevation(pd.to_numeric(df[x]).values, pd.to_numeric(df[y]).values,
+                                        srtm_pth, cache)
+    return df
+
+
+"""
+Hazard rasters on the network
+
+gn.sample_raster sets the raster value on each node of G one by one, leaves out nodes
+outside the raster, and the notebook then loops over G.nodes to fill those with 0.
+Here every node (or edge) is sampled in one gather and the result is a dense array in
+the CSRGraph's node (or edge) order, so it can be saved next to the graph with
+an.save_attribute and passed straight to ao.disrupt / ao.flood_sweep.
+"""
+
+def sample_nodes(csr, raster_path, fill = 0.0, cache = None):
+    """
+    Raster value at every node of a CSRGraph (x, y in the raster's CRS).
+
+    Nodes outside the raster or on nodata cells get fill (0: not flooded). Pass fill = np.nan
+    to tell them apart from dry cells.
+    """
+    cache = tile_cache if cache is None else cache
+    arr, transform, nodata = cache.get(raster_path)
+    vals = sample_array(arr, transform, csr.x, csr.y, nodata)
+    vals[np.isnan(vals)] = fill
+    return vals
+
+
+def _spaced_fractions(length, spacing):
+    # Sample positions every spacing along lines of the given lengths, ends included:
+    # line of each sample, fraction along it, and position of each line's first sample.
+    n = np.ceil(np.asarray(length) / spacing).astype(np.int64) + 1
+    start = np.zeros(len(n), dtype = np.int64)
+    np.cumsum(n[:-1], out = start[1:])
+    seg = np.repeat(np.arange(len(n)), n)
+    frac = (np.arange(n.sum()) - start[seg]) / np.maximum(n[seg] - 1, 1)
+    return seg, frac, start
+
+
+def sample_edges(csr, raster_path, spacing, geoms = None, fill = 0.0, cache = None):
+    """
+    Maximum raster value along every edge of a CSRGraph, in CSR edge order.
+
+    Edges are sampled every spacing (in the raster's CRS units, e.g. ~0.0001 degrees = 10 m)
+    along the straight line between their nodes, or along geoms (shapely lines in CSR edge
+    order, e.g. from gn.edge_gdf_from_graph) when given. Edges entirely outside the raster
+    or on nodata get fill.
+    """
+    cache = tile_cache if cache is None else cache
+    arr, transform, nodata = cache.get(raster_path)
+    if geoms is None:
+        src = csr.edge_sources()
+        dst = np.asarray(csr.indices)
+        x0, y0, x1, y1 = csr.x[src], csr.y[src], csr.x[dst], csr.y[dst]
+        seg, frac, start = _spaced_fractions(np.hypot(x1 - x0, y1 - y0), spacing)
+        px = x0[seg] + frac * (x1 - x0)[seg]
+        py = y0[seg] + frac * (y1 - y0)[seg]
+    else:
+        import shapely
+        geoms = np.asarray(geoms, dtype = object)
+        seg, frac, start = _spaced_fractions(shapely.length(geoms), spacing)
+        pts = shapely.line_interpolate_point(geoms[seg], frac, normalized = True)
+        px, py = shapely.get_x(pts), shapely.get_y(pts)
+
+    vals = sample_array(arr, transform, px, py, nodata)
+    vals[np.isnan(vals)] = -np.inf
+    out = np.maximum.reduceat(vals, start) if len(start) else np.zeros(0)
+    out[np.isinf(out)] = fill
+    return out
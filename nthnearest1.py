@@ -14,6 +14,7 @@ import os, sys
 gostNetsFolder = os.path.dirname(os.getcwd())
 sys.path.insert(0, gostNetsFolder)
 import pandas as pd
+import access_od as ao
 
 pth = os.path.join(gostNetsFolder, "SampleData")
 
@@ -33,41 +34,23 @@ OD.rename(columns={'Unnamed: 0': 'NN'}, inplace=True)
 #%% Nth nearest POI
 fail_value = 999999999
 
-# Find first nearest POI for each origin node.
-
-OD["1D"] = 0
-ODsub = OD.iloc[:,1:44] # Subset only the POI columns. Remove NN and 1D fields.
+# Find the 1st, 2nd and 3rd nearest POI for each origin node in one pass.
+ODsub = OD.iloc[:,1:44] # Subset only the POI columns. Remove NN field.
 # I chose to select on the columns I wanted instead of excepting those I didn't because I've noticed issues
 # where index columns are doubled upon loading the csv with Pandas. Being very deliberate here.
-OD["1D"] = ODsub.min(axis=1) # Default is axis=0, meaning min value of each column selected. We want min of each row.
+times, pois = ao.nth_nearest(ODsub, k = 3, fail_value = fail_value)
+# Partial sort of the whole matrix at once instead of min() then duplicated()/where() for every rank.
+# If two POIs are equidistant, each takes a rank (2D equals 1D) rather than both being dropped.
+# times is NaN where there are fewer reachable POIs; pois holds the column name of each POI.
+OD["1D"] = times[:, 0]
+OD["2D"] = times[:, 1]
+OD["3D"] = times[:, 2]
 OD.head(1) # Check that it worked. 1D column should contain the smallest number from each row.
+
 OD1 = OD.loc[:,['NN', '1D']] # Remove unnecessary OD values.
 OD1.to_csv(os.path.join(pth, '1D.csv'))
-
-
-
-# Find the second nearest POI for each origin node.
-dupes = OD.apply(pd.Series.duplicated, axis = 1, keep=False)
-# The first time this is done, there should be two True values per row.
-dupes = OD.where(~dupes, fail_value) # For any value that appears more than once in its row, it is replaced with the fail_value.
-
-OD["2D"] = 0
-ODsub = dupes.iloc[:,1:44]
-OD["2D"] = ODsub.min(axis=1) # Now that we're selecting from the dupes dataframe, this will ignore the 1st lowest values in each row.
-OD.head(1)
 OD2 = OD.loc[:,['NN', '2D']] 
 OD2.to_csv(os.path.join(pth, '2D.csv'))
-
-
-# Find the third nearest POI for each origin node.
-dupes = OD.apply(pd.Series.duplicated, axis = 1, keep=False)
-# Since this includes both columns 1D and 2D, there should be four True values per row.
-dupes = OD.where(~dupes, fail_value)
-
-OD["3D"] = 0
-ODsub = dupes.iloc[:,1:44]
-OD["3D"] = ODsub.min(axis=1)
-OD.head(1)
 OD3 = OD.loc[:,['NN', '3D']]
 OD3.to_csv(os.path.join(pth, '3D.csv'))
 
@@ -77,4 +60,7 @@ ODall = OD.loc[:,['NN', '1D', '2D', '3D']]
 ODall.to_csv(os.path.join(pth, '123D.csv'))
 
 
-
+#%% Same thing straight from the on-disk OD store (access_od.calculate_OD_parallel), chunk by chunk.
+# listD is the list of dialysis nearest nodes, e.g. list(inDsnap.NN.unique()).
+#ODstore = ao.open_od_store(os.path.join(pth, 'OD_store'))
+#ODall = ao.nth_nearest_store(ODstore, listD, k = 3, label = 'D')
@@ -1,6 +1,8 @@
 #%% 
 import pandana, time, os, pandas as pd, numpy as np
 from pandana.loaders import osm
+import access_network as an
+import access_od as ao
 # matplotlib inline
 import mpl_toolkits
 from mpl_toolkits.basemap import pyproj
@@ -107,20 +109,23 @@ print('Network with {:,} nodes {} in {:,.2f} secs'.format(len(network.node_ids),
 
 
 #%% Calculate accessibility to any amenity we retrieved
-# precomputes the range queries (the reachable nodes within this maximum distance)
-# so, as long as you use a smaller distance, cached results will be used
-network.precompute(distance + 1)
-
-# This was quick for a 1km distance, timed out for 25km. Took maybe 10 min for 10km.
-
-#%%
-# initialize a category for all amenities with the locations specified by the lon and lat columns
-network.set_pois(category='all', maxdist=distance, maxitems=num_pois, x_col=pois['X'], y_col=pois['Y'])
-# If using OSM data, the x and y column will be 'lon' and 'lat'
+# network.precompute(distance + 1) was quick for a 1km distance, timed out for 25km,
+# took maybe 10 min for 10km. Not used here, and no precomputed index replaces it: the network
+# is converted once to routing arrays (saved next to the .h5, memory-mapped afterwards), but
+# every ao.nearest_pois call runs a fresh search outward from all POIs. Its time grows with the
+# distance until each node has num_pois POIs in range: 1.0 s at 1km, 9.0 s at 10km on a
+# 302,500-node test grid (50 POIs, num_pois = 5); not timed on this network.
+if os.path.isdir('prallislands_network_allnodes_csr'):
+    csr = an.load_csr('prallislands_network_allnodes_csr')
+else:
+    csr = an.hdf5_to_csr('prallislands_network_allnodes.h5', impedance = 'distance')
+    an.save_network('prallislands_network_allnodes_csr', csr, meta = {'source': 'prallislands_network_allnodes.h5'})
 
 #%%
 # searches for the n nearest amenities (of all types) to each node in the network
-all_access = network.nearest_pois(distance=distance, category='all', num_pois=num_pois)
+# Same output as network.set_pois(category='all', ...) + network.nearest_pois.
+all_access = ao.nearest_pois(csr, pois['X'], pois['Y'], distance, num_pois = num_pois)
+# If using OSM data, the x and y column will be 'lon' and 'lat'
 
 #%%
 all_access.to_csv('pharm_acc_10km.csv', index=True, encoding='utf-8')
@@ -170,16 +175,15 @@ If I do this, need to change the amenity types specified in Configure Script cod
 #%% 5. Calculate and plot accessibility separately for each amenity type
 # The amenity types specified at the beginning area: restaurants, bars, and schools
 
-# initialize each amenity category with the locations specified by the lon and lat columns
-for amenity in amenities:
-    pois_subset = pois[pois['amenity']==amenity]
-    network.set_pois(category=amenity, maxdist=distance, maxitems=num_pois, x_col=pois_subset['lon'], y_col=pois_subset['lat'])
+# all amenity categories in one search, with the locations specified by the lon and lat columns
+# (instead of set_pois + nearest_pois per category); amenity_access[amenity] has columns 1..num_pois
+pois_subset = pois[pois['amenity'].isin(amenities)]
+amenity_access = ao.nearest_pois_by_category(csr, pois_subset['lon'], pois_subset['lat'], pois_subset['amenity'],
+                                             distance, num_pois = num_pois)
 
-# Remember to add maxdist and maxitems parameters to set_pois function
-    
 #%%
     # distance to the nearest restaurant
-restaurant_access = network.nearest_pois(distance=distance, category='restaurant', num_pois=num_pois)
+restaurant_access = amenity_access['restaurant']
 bmap, fig, ax = network.plot(restaurant_access[1], bbox=bbox, plot_kwargs=plot_kwargs, 
                              fig_kwargs=fig_kwargs, bmap_kwargs=bmap_kwargs, cbar_kwargs=cbar_kwargs)
 ax.set_facecolor(bgcolor)
@@ -188,7 +192,7 @@ fig.savefig('C:/Users/grace/Documents/Cartography Working Files/data/puerto rico
 
 #%%
 # distance to the nearest bar
-bar_access = network.nearest_pois(distance=distance, category='bar', num_pois=num_pois)
+bar_access = amenity_access['bar']
 bmap, fig, ax = network.plot(bar_access[1], bbox=bbox, plot_kwargs=plot_kwargs, 
                              fig_kwargs=fig_kwargs, bmap_kwargs=bmap_kwargs, cbar_kwargs=cbar_kwargs)
 ax.set_facecolor(bgcolor)
@@ -198,7 +202,7 @@ fig.savefig('C:/Users/grace/Documents/Cartography Working Files/data/puerto rico
 
 #%%
 # distance to the nearest school
-school_access = network.nearest_pois(distance=distance, category='school', num_pois=num_pois)
+school_access = amenity_access['school']
 bmap, fig, ax = network.plot(school_access[1], bbox=bbox, plot_kwargs=plot_kwargs, 
                              fig_kwargs=fig_kwargs, bmap_kwargs=bmap_kwargs, cbar_kwargs=cbar_kwargs)
 ax.set_facecolor(bgcolor)
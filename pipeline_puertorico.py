@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Puerto Rico accessibility pipeline, declared as stages (see access_gn_puertorico6_all.py
+for the same steps as notebook-style cells).
+
+Each stage is keyed by its code, the source of the access_* helper modules it calls,
+its parameters, input files and upstream stages; rerunning this script only reruns what
+changed (e.g. editing speed_dict reruns the time conversion and everything downstream, but
+not the graph build or the loading of the services). Settings a stage uses (speed_dict,
+fail_value, snap_k, min_nodes) are passed as parameters, so they are keyed too; stage
+functions read no module-level constants. Files a stage reads without declaring them are
+not keyed; use run(force = [...]) after changing those.
+The road graphs (graph, network) are stored as network artifacts, other outputs as Parquet
+or pickles (see ap.Pipeline).
+Independent stages (the five service snaps, node elevation, the five nearest-POI
+sweeps) run in parallel. The ~1 million origins are streamed in batches through snapping,
+elevation, walk and multimodal times into the municipal ratings (ap.stream_origins), so
+they are never loaded whole. Outputs and a manifest with timings go to SampleData/pipeline.
+"""
+
+#%%
+import os, sys
+gostNetsFolder = os.path.dirname(os.getcwd())
+sys.path.insert(0, gostNetsFolder)
+import pandas as pd
+import access_network as an
+import access_od as ao
+import access_origins as aor
+import access_raster as ar
+import access_osm as aosm
+import access_pipeline as ap
+
+pth = os.path.join(gostNetsFolder, "SampleData")
+fail_value = 999999999
+snap_k = 8 # road nodes tried per point before giving up on reaching the main network
+min_nodes = 100 # smaller road pieces are not part of the main network
+
+speed_dict = {
+                'residential': 20,  # kmph
+                'primary': 40, # kmph
+                'primary_link':35,
+                'motorway':45,
+                'motorway_link': 40,
+                'trunk': 40,
+                'trunk_link':35,
+                'secondary': 30, # kmph
+                'secondary_link':25,
+                'tertiary':30,
+                'tertiary_link': 25,
+                'unclassified':20,
+                'road':20,
+                'crossing':20,
+                'living_street':20
+                }
+
+services = {'D': 'dialysis2wgs84.shp', 'H': 'hospitals2.shp', 'G': 'gas4wgs84.shp',
+            'P': 'pharm3wgs84.shp', 'E': 'education3wgs84.shp'}
+
+
+#%%
+"""
+Stages. Each takes its upstream outputs and parameters as keyword arguments.
+"""
+
+def load_points(path, columns = None):
+    # Cleaned points (shapefile) with x, y columns from the geometry.
+    import geopandas as gpd
+    df = gpd.read_file(path)
+    df['x'] = df.geometry.x
+    df['y'] = df.geometry.y
+    df = pd.DataFrame(df.drop(columns = 'geometry'))
+    return df if columns is None else df[columns + ['x', 'y']]
+
+
+def build_graph(pbf, aoi):
+    import geopandas as gpd
+    bound = gpd.read_file(aoi).geometry.iloc[0]
+    return aosm.pbf_to_csr(pbf, aoi = bound)
+
+
+def time_conversion(graph, speed_dict):
+    return an.with_speeds(graph, speed_dict)
+
+
+def snap_index(network, min_nodes):
+    # Snap index plus the mask of nodes on the main network (pieces of at least min_nodes nodes).
+    return {'index': aor.build_snap_index(network, source_crs = 'epsg:4326', target_crs = 'epsg:3920'),
+            'valid': an.component_mask(network, min_nodes = min_nodes)}
+
+
+def snap(snap_index, points, k):
+    return aor.snap_points(snap_index['index'], points, k = k, valid = snap_index['valid'])
+
+
+def node_elevation(network, srtm_pth):
+    elev = ar.sample_elevation(network.x, network.y, srtm_pth)
+    return pd.DataFrame({'NN': network.node_ids, 'node_elev': elev})
+
+
+def nearest(network, snap_X, label, fail_value):
+    # 1st, 2nd and 3rd nearest POI from every road node, in minutes (NaN where there is no path),
+    # and the node of each POI (1<label>_id...), which multimodal routing needs to tell them apart.
+    out = ao.nearest_k(network, snap_X.NN, k = 3, label = label, fail_value = fail_value)
+    for r in ['1', '2', '3']:
+        out[r + label] = out[r + label].where(out[r + label] < fail_value) / 60
+    return out
+
+
+def municipal(origins, snap_index, node_elevation, nearest_D, nearest_H, nearest_G, nearest_P, nearest_E,
+              srtm_pth, batch_size = 100000, access_nodes = 4):
+    # Best walk + drive time to the nth nearest POI for every origin, walking to any of its
+    # access_nodes nearest road nodes, streamed in batches into the municipal ratings (the R
+    # script's, plus percentiles and shares beyond 30 / 60 minutes), so the million origins
+    # are never in memory at once.
+    near = {'D': nearest_D, 'H': nearest_H, 'G': nearest_G, 'P': nearest_P, 'E': nearest_E}
+    acc = ap.stream_origins(origins, snap_index['index'], node_elevation, near, srtm_pth,
+                            valid = snap_index['valid'], batch_size = batch_size, access_nodes = access_nodes)
+    return acc.frame('xmid')
+
+
+#%%
+"""
+Declare and run.
+"""
+
+def declare(workers = None):
+    p = ap.Pipeline(os.path.join(pth, 'pipeline'), workers = workers)
+    for label, f in services.items():
+        p.stage('load_' + label, load_points, params = {'path': os.path.join(pth, f)},
+                files = [os.path.join(pth, f)])
+    pbf = os.path.join(pth, 'puerto-rico-latest.osm.pbf')
+    aoi = os.path.join(pth, 'prboundingwgs84.shp')
+    p.stage('graph', build_graph, params = {'pbf': pbf, 'aoi': aoi}, files = [pbf, aoi])
+    p.stage('network', time_conversion, inputs = ['graph'], params = {'speed_dict': speed_dict})
+    p.stage('snap_index', snap_index, inputs = ['network'], params = {'min_nodes': min_nodes})
+    for label in services:
+        p.stage('snap_' + label, snap, inputs = {'snap_index': 'snap_index', 'points': 'load_' + label},
+                params = {'k': snap_k})
+    srtm = os.path.join(pth, 'tile_index.json')
+    p.stage('node_elevation', node_elevation, inputs = ['network'], params = {'srtm_pth': pth}, files = [srtm])
+    for label in services:
+        p.stage('nearest_' + label, nearest, inputs = {'network': 'network', 'snap_X': 'snap_' + label},
+                params = {'label': label, 'fail_value': fail_value})
+    origins = os.path.join(pth, 'wpop3wgs84.shp')
+    p.stage('municipal', municipal, inputs = ['snap_index', 'node_elevation'] + ['nearest_' + l for l in services],
+            params = {'origins': origins, 'srtm_pth': pth}, files = [origins, srtm])
+    return p
+
+
+if __name__ == '__main__':
+    pipeline = declare()
+    timings = pipeline.run()
+    print(timings)
+    mm = pipeline.load('municipal')
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import access_aggregate as aa
+
+
+def _origins(n = 500, seed = 0):
+    rng = np.random.RandomState(seed)
+    times = pd.DataFrame({'1D': rng.uniform(0, 120, n), 'mm1D': rng.uniform(0, 400, n)})
+    times.loc[rng.rand(n) < 0.1, '1D'] = np.nan # no path
+    group = rng.choice([3, 7, 11, 20], n).astype(float)
+    group[:5] = np.nan # origins without a municipio are skipped
+    return group, rng.uniform(0, 50, n), times
+
+
+def test_municipal_batches_and_merge():
+    group, wpop, times = _origins()
+    cols = ['1D', 'mm1D']
+    whole = aa.MunicipalAccumulator(cols).add(group, wpop, times).frame()
+
+    # Batches added one after another, and accumulators of separate batches merged,
+    # give the whole table's result (groups first seen in a later batch included).
+    order = np.argsort(group)
+    batched = aa.MunicipalAccumulator(cols)
+    merged = aa.MunicipalAccumulator(cols)
+    for rows in np.array_split(order, 4):
+        batched.add(group[rows], wpop[rows], times.iloc[rows])
+        merged.merge(aa.MunicipalAccumulator(cols).add(group[rows], wpop[rows], times.iloc[rows]))
+    pd.testing.assert_frame_equal(batched.frame(), whole)
+    pd.testing.assert_frame_equal(merged.frame(), whole)
+
+    # Against the R script's weighted sums, over the reached population.
+    ok = np.isfinite(group)
+    df = pd.DataFrame({'xmid': group[ok], 'wpop': wpop[ok], 't': times['1D'].values[ok]})
+    reached = df[df.t.notna()]
+    mean = (reached.t * reached.wpop).groupby(reached.xmid).sum() / reached.groupby('xmid').wpop.sum()
+    beyond = df.wpop.where(~(df.t <= 30), 0).groupby(df.xmid).sum() / df.groupby('xmid').wpop.sum()
+    out = whole[whole.variable == '1D'].set_index('xmid')
+    assert list(out.index) == [3, 7, 11, 20]
+    assert np.allclose(out['mean'], mean.values)
+    assert np.allclose(out['beyond30'], beyond.values)
+    assert np.allclose(out['wpopm'], df.groupby('xmid').wpop.sum().values)
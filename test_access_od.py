@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import os
+import warnings
+import pytest
+import numpy as np
+import pandas as pd
+import networkx as nx
+import access_network as an
+import access_od as ao
+
+
+def _grid(seed = 0):
+    # Small directed grid with random travel times, node IDs offset from the indices.
+    rng = np.random.RandomState(seed)
+    G = nx.DiGraph()
+    for u, v in nx.grid_2d_graph(6, 6).edges():
+        a, b = 100 + u[0] * 6 + u[1], 100 + v[0] * 6 + v[1]
+        G.add_edge(a, b, time = float(rng.randint(1, 20)))
+        G.add_edge(b, a, time = float(rng.randint(1, 20)))
+    return G
+
+
+def _brute(G, dests, k):
+    # k smallest times from every node to the destinations, by one Dijkstra per destination.
+    R = G.reverse()
+    per = [nx.single_source_dijkstra_path_length(R, d, weight = 'time') for d in dests]
+    return {v: sorted(p[v] for p in per if v in p)[:k] for v in G.nodes()}
+
+
+def _check(result, G, dests, k):
+    expect = _brute(G, dests, k)
+    for i, v in enumerate(result.node_ids):
+        t = expect[v] + [result.fail_value] * (k - len(expect[v]))
+        assert np.allclose(result.times[i], t)
+
+
+def test_nearest_k_and_disrupt_chaining():
+    G = _grid()
+    dests = [100, 117, 135, 122]
+    base = ao.nearest_k_search(G, dests, k = 3)
+    _check(base, G, dests, 3)
+
+    # Block one node, then another on top of the first result.
+    csr = ao.as_csr(G)
+    first = np.isin(csr.node_ids, [114])
+    one, redo = ao.disrupt(base, csr, blocked_nodes = first)
+    H = G.copy()
+    H.remove_edges_from(list(H.in_edges(114)) + list(H.out_edges(114)))
+    _check(one, H, dests, 3)
+    assert redo.any() and not redo.all()
+
+    second = first | np.isin(csr.node_ids, [128])
+    two, _ = ao.disrupt(one, csr, blocked_nodes = second)
+    H.remove_edges_from(list(H.in_edges(128)) + list(H.out_edges(128)))
+    _check(two, H, dests, 3)
+    assert np.array_equal(base.times, ao.nearest_k_search(G, dests, k = 3).times) # baseline untouched
+
+
+def test_nearest_k_missing_destinations():
+    G = _grid()
+    with warnings.catch_warnings(record = True) as w:
+        warnings.simplefilter('always')
+        result = ao.nearest_k_search(G, [100, 5, 117, 7], k = 2)
+    assert len(w) == 1
+    assert list(result.missing) == [5, 7]
+    _check(result, G, [100, 117], 2)
+
+
+def test_od_store_resume(tmp_path):
+    G = _grid()
+    csr = ao.as_csr(G)
+    csr_folder, store_folder = str(tmp_path / 'csr'), str(tmp_path / 'od')
+    an.save_csr(csr, csr_folder)
+    origins, dests = list(range(100, 136, 2)), [100, 117, 135]
+    full = ao.calculate_OD_parallel(csr_folder, origins, dests, store_folder, chunk_size = 5, workers = 1)
+    expect = np.array([[nx.dijkstra_path_length(G, o, d, weight = 'time') for d in dests] for o in origins])
+    assert np.allclose(full.block(), expect)
+
+    # Lose chunk 1 and scribble on chunk 0 (still marked done): only chunk 1 is recomputed.
+    store = ao.open_od_store(store_folder, 'r+')
+    store.times[store.chunk_slice(0)] = -1
+    store.times[store.chunk_slice(1)] = 0
+    store.times.flush()
+    done = store.done()
+    done[1] = False
+    np.save(os.path.join(store_folder, 'done.npy'), done)
+    assert ao.open_od_store(store_folder).missing_chunks() == [1]
+
+    again = ao.calculate_OD_parallel(csr_folder, origins, dests, store_folder, chunk_size = 5, workers = 1)
+    assert (again.block(rows = again.chunk_slice(0)) == -1).all()
+    assert np.allclose(again.block()[5:], expect[5:])
+    assert again.missing_chunks() == []
+
+
+def test_od_store_empty(tmp_path):
+    with pytest.raises(ValueError):
+        ao.create_od_store(str(tmp_path / 'od'), [], [1, 2])
+
+
+def test_nth_nearest_ties_and_fail_value():
+    fail = ao.fail_value
+    block = pd.DataFrame([[5.0, 3.0, 5.0, 9.0],
+                          [fail, np.nan, 2.0, fail + 1],
+                          [np.nan, fail, fail, fail]], columns = [11, 12, 13, 14])
+    times, ids = ao.nth_nearest(block, k = 3)
+    # Equidistant destinations each take a rank.
+    assert np.array_equal(times[0], [3, 5, 5])
+    assert ids[0, 0] == 12 and set(ids[0, 1:]) == {11, 13}
+    # NaN and anything at or above the fail value is no path.
+    assert times[1, 0] == 2 and ids[1, 0] == 13
+    assert np.isnan(times[1, 1:]).all() and (ids[1, 1:] == -1).all()
+    assert np.isnan(times[2]).all() and (ids[2] == -1).all()
+
+    # More ranks than destinations.
+    times, ids = ao.nth_nearest(block.values[:, :2], k = 3)
+    assert np.array_equal(times[0, :2], [3, 5]) and np.array_equal(ids[0], [1, 0, -1])
+
+
+def test_merge_candidates():
+    fail = ao.fail_value
+    times = [[4.0, 2.0, 3.0, 1.0, np.nan, fail],
+             [5.0, 5.0, 1.0, 0.0, 9.0, 9.0]]
+    ids = [[10, 20, 10, -1, 30, 40],
+           [10, 10, 20, 20, -1, -1]]
+    best, best_ids = ao.merge_candidates(times, ids, k = 3)
+    # Each destination once, at its fastest; no candidate, NaN and the fail value are dropped.
+    assert np.array_equal(best[0], [2, 3, fail]) and np.array_equal(best_ids[0], [20, 10, -1])
+    assert np.array_equal(best[1], [0, 5, fail]) and np.array_equal(best_ids[1], [20, 10, -1])
+
+
+def test_nearest_multimodal():
+    G = _grid()
+    dests = [100, 117, 135, 122]
+    near = ao.nearest_k(G, dests, k = 3, label = 'D')
+    rng = np.random.RandomState(1)
+    nodes = rng.choice(list(G.nodes()), (20, 3))
+    nodes[0, 1:] = -1 # only one node to walk to
+    nodes[1, 0] = 999 # not a road node
+    walk = rng.uniform(0, 10, (20, 3))
+    walk[2, 0] = np.nan # walk time unknown
+    out = ao.nearest_multimodal(near, nodes, walk, k = 3, label = 'D')
+
+    R = G.reverse()
+    drive = {d: nx.single_source_dijkstra_path_length(R, d, weight = 'time') for d in dests}
+    for i in range(len(nodes)):
+        best = {}
+        for j in range(3):
+            if nodes[i, j] in G and np.isfinite(walk[i, j]):
+                for d in dests:
+                    t = walk[i, j] + drive[d][nodes[i, j]]
+                    best[d] = min(best.get(d, np.inf), t)
+        expect = sorted(best.values())[:3]
+        assert np.allclose(out.loc[i, ['mm1D', 'mm2D', 'mm3D']], expect)
+        for r in range(3):
+            assert np.isclose(best[out.loc[i, 'mm%dD_id' % (r + 1)]], expect[r])
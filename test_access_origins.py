@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import access_origins as aor
+
+
+def test_walk_times_zero_distance_with_missing_elevation():
+    speed, time = aor.walk_times([0.0, 0.0, 100.0, np.nan], [np.nan, 5.0, np.nan, 0.0])
+    assert time[0] == 0 and time[1] == 0
+    assert np.isnan(time[2]) and np.isnan(time[3])
+    assert np.isclose(speed[0], 6 * np.exp(-3.5 * 0.05))
+
+
+def test_generate_walktimes_origin_on_node():
+    df = pd.DataFrame({'point_elev': [np.nan, 10.0], 'node_elev': [20.0, 10.0], 'NN_dist': [0.0, 1000.0]})
+    out = aor.generate_walktimes(df)
+    assert out['walk_time'].iloc[0] == 0
+    assert np.isclose(out['walk_time'].iloc[1], 3600 / (6 * np.exp(-3.5 * 0.05)), rtol = 1e-5)
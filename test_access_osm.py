@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import access_network as an
+import access_osm as aosm
+
+
+def _ways():
+    # Way 0 (two-way) 1-2-3-4, way 1 (oneway) 3-5-6 sharing node 3, way 2 (oneway = -1) 7-4.
+    way_len = np.array([4, 3, 2])
+    refs = np.array([1, 2, 3, 4, 3, 5, 6, 7, 4], dtype = np.int64)
+    lon = np.array([0.0, 0.001, 0.002, 0.003, 0.002, 0.002, 0.002, 0.004, 0.003])
+    lat = np.array([0.0, 0.0005, 0.0, 0.0, 0.0, 0.001, 0.002, 0.0, 0.0])
+    highway = np.array(['primary', 'residential', 'service'])
+    oneway = np.array([0, 1, -1], dtype = np.int8)
+    return way_len, refs, lon, lat, highway, oneway
+
+
+def test_ways_to_csr_splits_and_oneway():
+    way_len, refs, lon, lat, highway, oneway = _ways()
+    csr = aosm.ways_to_csr(way_len, refs, lon, lat, highway, oneway)
+    assert sorted(csr.node_ids) == [1, 3, 4, 6, 7] # 2 and 5 are inside a single way
+    edges = set(zip(csr.node_ids[csr.edge_sources()], csr.node_ids[csr.indices]))
+    assert edges == {(1, 3), (3, 1), (3, 4), (4, 3), (3, 6), (4, 7)}
+
+    def weight(u, v):
+        return csr.edge_weight(csr.index_of([u]), csr.index_of([v]))[0]
+    h = aosm.haversine
+    assert np.isclose(weight(1, 3), h(0, 0, 0.001, 0.0005) + h(0.001, 0.0005, 0.002, 0), rtol = 1e-6)
+    assert np.isclose(weight(3, 1), weight(1, 3))
+    assert np.isclose(weight(3, 6), h(0.002, 0, 0.002, 0.002), rtol = 1e-6)
+    assert np.isclose(weight(4, 7), h(0.003, 0, 0.004, 0), rtol = 1e-6)
+
+    # The split-off nodes are kept as the edge geometry, in the direction of travel.
+    src, dst = csr.node_ids[csr.edge_sources()], csr.node_ids[csr.indices]
+    geom = an.edge_geometry(csr)
+    e13 = np.flatnonzero((src == 1) & (dst == 3))[0]
+    e31 = np.flatnonzero((src == 3) & (dst == 1))[0]
+    assert np.allclose(np.asarray(geom[e13].coords), [[0, 0], [0.001, 0.0005], [0.002, 0]])
+    assert np.allclose(np.asarray(geom[e31].coords), [[0.002, 0], [0.001, 0.0005], [0, 0]])
+
+
+def test_ways_to_csr_aoi():
+    way_len, refs, lon, lat, highway, oneway = _ways()
+    csr = aosm.ways_to_csr(way_len, refs, lon, lat, highway, oneway, aoi = (-1, -1, 0.0035, 1))
+    edges = set(zip(csr.node_ids[csr.edge_sources()], csr.node_ids[csr.indices]))
+    assert edges == {(1, 3), (3, 1), (3, 4), (4, 3), (3, 6)} # node 7 is outside